@@ -0,0 +1,183 @@
+# audit.py
+
+"""
+Asynchronous, batched audit log for the chat application.
+
+Writing the audit record with `logger.info(...)` inside `chat()` puts the log handlers,
+and with OpenTelemetry the log exporter, on the path of every turn. `AuditSink` moves
+that work to a background thread:
+
+- `emit()` only puts the record on a bounded queue, so it takes constant time.
+- A worker thread takes records off the queue in batches, serialises them and writes
+  them to the configured sinks.
+- When the queue is full the overflow policy decides: `drop` (the default) drops the
+  record and counts it, `block` waits for space.
+- `close()` flushes what is left in the queue, it is called on shutdown.
+
+The sinks are configured with AUDIT_SINKS, a comma separated list of:
+- `log`: re-emit the record through the `audit` logger from the worker thread. When the app
+  runs under `opentelemetry-instrument` this is exported over OTLP like any other log.
+- `file`: append the record as a JSON line to a gzip compressed file (AUDIT_FILE), which is
+  rotated when it grows past AUDIT_MAX_BYTES, keeping AUDIT_BACKUP_COUNT old files.
+"""
+
+import os
+import json
+import gzip
+import time
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+
+from opentelemetry import trace
+
+import telemetry
+
+
+logger = logging.getLogger()
+
+AUDIT_SINKS = [sink.strip() for sink in os.getenv("AUDIT_SINKS", "log").split(",") if sink.strip()]
+AUDIT_FILE = os.getenv("AUDIT_FILE", "audit/audit.jsonl.gz")
+AUDIT_MAX_BYTES = int(os.getenv("AUDIT_MAX_BYTES", str(50 * 1024 * 1024)))
+AUDIT_BACKUP_COUNT = int(os.getenv("AUDIT_BACKUP_COUNT", "5"))
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "256"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+AUDIT_OVERFLOW = os.getenv("AUDIT_OVERFLOW", "drop")
+
+# Put on the queue to tell the worker to flush and stop
+_STOP = object()
+
+
+class AuditSink:
+    """
+    Bounded queue of audit records written in batches by a background thread.
+
+    Args:
+        sinks (list): Where to write the records, `log` and/or `file`.
+        path (str): The path of the compressed JSON lines file for the `file` sink.
+        queue_size (int): The maximum number of records waiting to be written.
+        batch_size (int): The maximum number of records written in one go.
+        flush_interval (float): The longest a record waits for a batch to fill, in seconds.
+        overflow (str): What to do when the queue is full, `drop` or `block`.
+    """
+
+    def __init__(self, sinks=AUDIT_SINKS, path=AUDIT_FILE, queue_size=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL, overflow=AUDIT_OVERFLOW):
+        if overflow not in ["drop", "block"]:
+            raise ValueError(f"Unknown audit overflow policy '{overflow}', use 'drop' or 'block'")
+        self.sinks = sinks
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.audit_logger = logging.getLogger("audit")
+        self.closed = False
+        if "file" in self.sinks:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.worker = threading.Thread(target=self._run, name="audit-sink", daemon=True)
+        self.worker.start()
+
+    def emit(self, message, record):
+        """
+        Queue an audit record for writing.
+
+        Args:
+            message (str): The human readable audit message.
+            record (dict): The structured audit fields.
+
+        Returns:
+            bool: True if the record was queued, False if it was dropped.
+        """
+        # The worker has no trace context, so keep the ids to correlate the record with the turn
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            record = dict(record, trace_id=format(span_context.trace_id, "032x"), span_id=format(span_context.span_id, "016x"))
+        entry = (time.time(), message, record)
+        if self.overflow == "block":
+            self.queue.put(entry)
+            return True
+        try:
+            self.queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            telemetry.record_audit_dropped()
+            return False
+
+    def close(self, timeout=5.0):
+        """
+        Write the records still in the queue and stop the worker.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        # Always wait for space, the stop marker must not be dropped
+        self.queue.put(_STOP)
+        self.worker.join(timeout)
+        if self.dropped:
+            logger.warning(f"Dropped {self.dropped} audit records because the audit queue was full")
+
+    def _run(self):
+        """
+        Worker loop: collect batches from the queue and write them.
+        """
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    # Never let a bad record or a full disk kill the worker
+                    logger.error(f"Failed to write {len(batch)} audit records: {e}")
+
+    def _write_batch(self, batch):
+        """
+        Write a batch of records to every configured sink.
+        """
+        if "log" in self.sinks:
+            for _, message, record in batch:
+                self.audit_logger.info(message, extra=record)
+        if "file" in self.sinks:
+            lines = []
+            for created, message, record in batch:
+                document = {"@timestamp": datetime.fromtimestamp(created, timezone.utc).isoformat(), "message": message}
+                document.update(record)
+                lines.append(json.dumps(document, default=str, separators=(",", ":")))
+            data = ("\n".join(lines) + "\n").encode("utf-8")
+            self._rotate_if_needed()
+            # Every batch is a complete gzip member, concatenated members are still a valid gzip file
+            with open(self.path, "ab") as file:
+                file.write(gzip.compress(data, compresslevel=5))
+
+    def _rotate_if_needed(self):
+        """
+        Rotate the audit file when it is larger than AUDIT_MAX_BYTES.
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < AUDIT_MAX_BYTES:
+            return
+        base, extension = self.path, ""
+        if self.path.endswith(".jsonl.gz"):
+            base, extension = self.path[:-len(".jsonl.gz")], ".jsonl.gz"
+        for number in range(AUDIT_BACKUP_COUNT - 1, 0, -1):
+            older = f"{base}.{number}{extension}"
+            if os.path.exists(older):
+                os.replace(older, f"{base}.{number + 1}{extension}")
+        if AUDIT_BACKUP_COUNT > 0:
+            os.replace(self.path, f"{base}.1{extension}")
+        else:
+            os.remove(self.path)
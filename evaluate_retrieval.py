@@ -0,0 +1,232 @@
+# evaluate_retrieval.py
+
+"""
+Retrieval evaluation harness: compare query templates (and mappings) on relevance and latency.
+
+Tuning `config/query_template.json` (inner_hits size, nested `sparse_vector` or BM25) and the
+mappings in `pdf-upload-tools/` used to be guesswork. This command runs a golden set of
+queries against one or more variants and reports, per variant:
+
+- recall@k: the share of the expected documents or passages found in the top k results
+- MRR: the mean reciprocal rank of the first relevant result
+- the mean size of the response body
+- p50 / p95 latency of the round trip, and the errors
+
+Variants are query template files (`--template`, repeatable, named after the file), each run
+against ELASTICSEARCH_INDEX or the index given after an `@` (`--template path@index`), so
+templates can be compared across mappings. With `--local` the embedded BM25 index from
+local_search.py is a variant too, which also works without a cluster.
+The queries of each variant run concurrently (`--concurrency`). Results are ranked passages:
+the inner hits of each hit in order, or the CONTEXT_FIELDS of the hit when there are none.
+
+The golden set is a JSON lines file, one query per line:
+    {"query": "white rabbit with a watch", "expected_ids": ["<document id>"], "expected_passages": ["took a watch out of its waistcoat"]}
+
+A result is relevant if it contains one of the `expected_passages` (case and whitespace
+insensitive), or, for queries without expected passages, if its document is in `expected_ids`.
+
+Usage:
+    python evaluate_retrieval.py config/golden_set.jsonl --template config/query_template.json \\
+        --template variants/bm25.json@pdfs-bm25 --local --k 5 --output evaluation.json
+"""
+
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+# Load the configuration before the modules below read it at import time
+load_dotenv(dotenv_path="./config/.env", override=True)
+
+import telemetry
+import rerank
+
+
+def load_golden_set(path):
+    """
+    Load the golden set queries from a JSON lines file.
+    """
+    queries = []
+    with open(path, "r") as file:
+        for line in file:
+            if line.strip():
+                record = json.loads(line)
+                queries.append({
+                    "query": record["query"],
+                    "expected_ids": record.get("expected_ids", []),
+                    "expected_passages": record.get("expected_passages", []),
+                })
+    return queries
+
+
+def _normalise(text):
+    return " ".join(text.lower().split())
+
+
+def judge(results, golden, k):
+    """
+    Score the ranked results of one query.
+
+    Args:
+        results (list): Ranked results with `id` and `text`.
+        golden (dict): The golden set entry.
+        k (int): The cut off for recall.
+
+    Returns:
+        tuple: Recall at k and the reciprocal rank of the first relevant result.
+    """
+    passages = [_normalise(passage) for passage in golden["expected_passages"]]
+    if passages:
+        matches = [{index for index, passage in enumerate(passages) if passage in _normalise(result["text"])} for result in results]
+        expected = len(passages)
+    else:
+        ids = golden["expected_ids"]
+        matches = [{ids.index(result["id"])} if result["id"] in ids else set() for result in results]
+        expected = len(ids)
+    found = set().union(*matches[:k]) if matches[:k] else set()
+    recall = len(found) / expected if expected else 0.0
+    reciprocal_rank = next((1 / rank for rank, match in enumerate(matches, start=1) if match), 0.0)
+    return recall, reciprocal_rank
+
+
+def elasticsearch_variant(name, template_path, es, index, context_fields):
+    """
+    Build a variant that runs the query template in `template_path` against Elasticsearch.
+
+    Returns:
+        function: Runs a query and returns the ranked results and the response size in bytes.
+    """
+    with open(template_path, "r") as file:
+        template = file.read()
+
+    def run(query_text):
+        # Same substitution as search(), the query escaped for JSON
+        body = json.loads(template.replace("{query}", json.dumps(query_text)[1:-1]))
+        response = es.options(headers=telemetry.elasticsearch_headers("evaluate", name)).search(index=index, body=body)
+        return rerank.candidates_from_hits(response.body, context_fields), len(json.dumps(response.body))
+    return run
+
+
+def local_variant(k):
+    """
+    Build a variant that runs the query against the embedded BM25 index.
+    """
+    import local_search
+    index = local_search.LocalIndex(os.getenv("LOCAL_SEARCH_INDEX", local_search.LOCAL_SEARCH_INDEX))
+
+    def run(query_text):
+        hits = index.search(query_text, k=k)
+        return hits, len(json.dumps(hits))
+    return run
+
+
+def evaluate(name, index, run, golden_set, k, concurrency, repeat):
+    """
+    Run the golden set against one variant.
+
+    Args:
+        name (str): The name of the variant.
+        index (str): The index the variant searches, for the report.
+
+    Returns:
+        dict: The figures for the variant.
+    """
+    def run_one(golden):
+        start = time.perf_counter()
+        try:
+            results, size = run(golden["query"])
+        except Exception as e:
+            return {"query": golden["query"], "error": f"{type(e).__name__}: {e}"}
+        latency = time.perf_counter() - start
+        recall, reciprocal_rank = judge(results, golden, k)
+        return {"query": golden["query"], "error": None, "latency_s": latency, "bytes": size,
+                "recall": recall, "reciprocal_rank": reciprocal_rank}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(run_one, golden_set * repeat))
+    successes = [outcome for outcome in outcomes if outcome["error"] is None]
+    latencies = [outcome["latency_s"] for outcome in successes]
+    # Relevance only depends on the query, so use the first run of each
+    first_runs = {outcome["query"]: outcome for outcome in reversed(successes)}.values()
+    return {
+        "variant": name,
+        "index": index,
+        "queries": len(golden_set),
+        "runs": len(outcomes),
+        "errors": len(outcomes) - len(successes),
+        f"recall@{k}": sum(outcome["recall"] for outcome in first_runs) / len(first_runs) if first_runs else None,
+        "mrr": sum(outcome["reciprocal_rank"] for outcome in first_runs) / len(first_runs) if first_runs else None,
+        "mean_bytes": sum(outcome["bytes"] for outcome in successes) / len(successes) if successes else None,
+        "p50_s": telemetry.percentile(latencies, 0.50),
+        "p95_s": telemetry.percentile(latencies, 0.95),
+        "per_query": list(first_runs),
+        "failures": sorted({outcome["error"] for outcome in outcomes if outcome["error"]}),
+    }
+
+
+def _format(value, pattern):
+    return "-" if value is None else pattern.format(value)
+
+
+def print_table(reports, k):
+    """
+    Print the comparison table of the variants.
+    """
+    print(f"{'variant':<24} {'index':<20} {'recall@' + str(k):>9} {'MRR':>6} {'bytes':>9} {'p50':>10} {'p95':>10} {'errors':>7}")
+    print("-" * 101)
+    for report in reports:
+        print(f"{report['variant']:<24} {report['index'] or '-':<20} {_format(report[f'recall@{k}'], '{:.2f}'):>9} {_format(report['mrr'], '{:.2f}'):>6} "
+              f"{_format(report['mean_bytes'], '{:.0f}'):>9} {_format(report['p50_s'] and report['p50_s'] * 1000, '{:.1f} ms'):>10} "
+              f"{_format(report['p95_s'] and report['p95_s'] * 1000, '{:.1f} ms'):>10} {report['errors']:>7}")
+        for failure in report["failures"][:3]:
+            print(f"  error: {failure[:120]}")
+
+
+def main():
+    """
+    Parse the arguments, run every variant and print and save the comparison.
+    """
+    parser = argparse.ArgumentParser(description="Compare query templates on retrieval quality and latency.")
+    parser.add_argument("golden_set", nargs="?", default="./config/golden_set.jsonl", help="JSON lines file of queries and expected results")
+    parser.add_argument("--template", action="append", default=[], help="Query template file to evaluate as path[@index], repeatable (default: config/query_template.json against ELASTICSEARCH_INDEX)")
+    parser.add_argument("--local", action="store_true", help="Also evaluate the embedded BM25 index (local_search.py)")
+    parser.add_argument("--k", type=int, default=5, help="Cut off for recall@k")
+    parser.add_argument("--concurrency", type=int, default=4, help="Queries run at the same time")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each query, for the latency percentiles")
+    parser.add_argument("--output", help="Write the full results as JSON to this file")
+    args = parser.parse_args()
+
+    golden_set = load_golden_set(args.golden_set)
+    templates = args.template or ([] if args.local else ["./config/query_template.json"])
+
+    variants = {}
+    if templates:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(os.getenv("ELASTICSEARCH_HOST"), api_key=os.getenv("ELASTICSEARCH_API_KEY"))
+        context_fields = os.getenv("CONTEXT_FIELDS", "content").split(",")
+        for template in templates:
+            path, _, index = template.rpartition("@") if "@" in template else (template, "", "")
+            name = os.path.splitext(os.path.basename(path))[0]
+            index = index or os.getenv("ELASTICSEARCH_INDEX")
+            if name in variants:
+                # The same template against another index
+                name = f"{name}@{index}"
+            variants[name] = (index, elasticsearch_variant(name, path, es, index, context_fields))
+    if args.local:
+        import local_search
+        variants["local-bm25"] = (os.getenv("LOCAL_SEARCH_INDEX", local_search.LOCAL_SEARCH_INDEX), local_variant(max(args.k, 10)))
+
+    reports = [evaluate(name, index, run, golden_set, args.k, args.concurrency, args.repeat) for name, (index, run) in variants.items()]
+    print(f"{len(golden_set)} queries, {args.repeat} runs each, concurrency {args.concurrency}")
+    print_table(reports, args.k)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"k": args.k, "golden_set": args.golden_set, "variants": reports}, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
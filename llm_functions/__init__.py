@@ -0,0 +1,19 @@
+class DirectReturn:
+    """
+    Wrap a function result to send it straight to the user.
+
+    `chat()` normally sends every function result back to the LLM to write the answer.
+    When the result needs no rewording a function can return `DirectReturn(value)` and
+    the answer is formatted from the template instead, saving an LLM call. A function
+    that always wants this can set `direct_return = True` (and optionally
+    `direct_return_template`) at module level instead.
+
+    Args:
+        value: The function result.
+        template (str): The answer, with `{result}` replaced by the value. Defaults to the
+            module's `direct_return_template` or just the value.
+    """
+
+    def __init__(self, value, template=None):
+        self.value = value
+        self.template = template
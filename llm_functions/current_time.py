@@ -10,6 +10,11 @@ definition = {
     }
 }
 
+keywords = ["what time", "time is it", "current time", "date", "today", "clock", "what day"]
+
+direct_return = True
+direct_return_template = "The current time is {result}."
+
 
 
 def current_time():
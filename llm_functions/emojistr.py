@@ -15,6 +15,11 @@ definition = {
     }
 }
 
+keywords = ["emoji", "emojis", "emoticon", "smiley", "shortcode"]
+
+direct_return = True
+direct_return_template = "{result}"
+
 def emojistr(emoji_shortcode):
     emoji_str = emoji.emojize(emoji_shortcode)
     return emoji_str
\ No newline at end of file
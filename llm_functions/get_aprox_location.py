@@ -13,6 +13,9 @@ definition = {
     }
 }
 
+keywords = ["location", "where am i", "where i am", "my city", "my country", "near me", "nearby",
+            "weather", "rain", "raining", "forecast", "temperature"]
+
 def get_aprox_location():
     """
     Get the location information from an IP address.
@@ -11,6 +11,11 @@ definition = {
     }
 }
 
+keywords = ["hostname", "host name", "machine name", "computer name", "server name"]
+
+direct_return = True
+direct_return_template = "This machine's hostname is {result}."
+
 def get_hostname():
     return socket.gethostname()
 
@@ -11,6 +11,11 @@ definition = {
     }
 }
 
+keywords = ["ip", "ip address", "public ip"]
+
+direct_return = True
+direct_return_template = "Your public IP address is {result}."
+
 
 
 def get_public_ip():
@@ -1,4 +1,5 @@
-import yfinance as yf
+# yfinance (and pandas with it) is slow to import, so it is imported on first use
+# (or in the background by warm_up(), see warmup.py) rather than when the module is loaded
 
 definition = {
     "name": "get_stock_info",
@@ -19,6 +20,15 @@ definition = {
     }
 }
 
+keywords = ["stock", "stocks", "share price", "stock price", "ticker", "stock market", "nasdaq", "nyse"]
+
+def warm_up():
+    """
+    Import yfinance before the first stock question.
+    """
+    import yfinance
+
+
 def get_stock_info(symbol, period):
     """
     Retrieves the stock price info for the given ticker symbol and period.
@@ -30,6 +40,7 @@ def get_stock_info(symbol, period):
     Returns:
         list: A list of dictionaries containing the stock price info for each day in the period.
     """
+    import yfinance as yf
     stock = yf.Ticker(symbol)
     data = stock.history(period=period)
     if not data.empty:
@@ -1,9 +1,5 @@
-import openmeteo_requests
-
-
-import requests_cache
-import pandas as pd
-from retry_requests import retry
+# The Open-Meteo libraries are slow to import, so they are imported on first use
+# (or in the background by warm_up(), see warmup.py) rather than when the module is loaded
 
 definition = {
     "name": "get_weather",
@@ -24,8 +20,23 @@ definition = {
     }
 }
 
+keywords = ["weather", "rain", "raining", "snow", "snowing", "sunny", "cloudy", "forecast",
+            "temperature", "umbrella", "windy"]
+
+def warm_up():
+    """
+    Import the Open-Meteo libraries before the first weather question.
+    """
+    import openmeteo_requests
+    import requests_cache
+    import retry_requests
+
+
 def get_weather(latitude, longitude):
     # This function should return the weather for the given location
+    import openmeteo_requests
+    import requests_cache
+    from retry_requests import retry
     
     # Setup the Open-Meteo API client with cache and retry on error
     cache_session = requests_cache.CachedSession('.cache', expire_after = 3600)
@@ -2,9 +2,15 @@
 import sys
 import json
 import os
+import time
+import random
+import threading
 from elasticsearch import Elasticsearch
+from elastic_transport import ConnectionError, ConnectionTimeout
 import logging
 sys.path.append("..")
+import telemetry
+from opentelemetry import trace
 
 
 # Get the logger from the main module
@@ -31,6 +37,59 @@ definition = {
         "required": ["query_text"]
     }
 }
+
+keywords = ["search", "find", "book", "books", "document", "documents", "story", "who", "what", "why"]
+
+# One client for every search, so its pooled connections are reused
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the shared Elasticsearch client, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Elasticsearch(
+                os.getenv("ELASTICSEARCH_HOST"),
+                api_key=os.getenv("ELASTICSEARCH_API_KEY")
+            )
+    return _client
+
+
+def warm_up():
+    """
+    Open a connection to Elasticsearch and check the credentials before the first search,
+    and open the local index if it is used.
+    """
+    LOCAL_SEARCH = os.getenv("LOCAL_SEARCH", "off").lower()
+    if LOCAL_SEARCH != "off":
+        import local_search
+        local_search.get_index()
+    if LOCAL_SEARCH != "primary":
+        get_client().info()
+
+
+def search_local(query_text):
+    """
+    Search the embedded BM25 index instead of Elasticsearch, see local_search.py.
+    """
+    # Imported on first use as it pulls in NumPy
+    import local_search
+    start = time.perf_counter()
+    if os.getenv("SEARCH_RERANK", "false").lower() == "true":
+        import rerank
+        result = reranked_result(query_text, local_search.get_index().search(query_text, k=rerank.RERANK_CANDIDATES))
+    else:
+        result = local_search.search_result(query_text)
+    span = trace.get_current_span()
+    span.set_attribute("search.engine", "local")
+    span.set_attribute("search.local.duration", time.perf_counter() - start)
+    return result
+
+
 def load_query_template():
     """
     Load the Elasticsearch query template from a JSON file.
@@ -39,37 +98,75 @@ def load_query_template():
         template = json.load(file)
     return template
 
+def build_query(query_text):
+    """
+    Build the search body from the query template for a query.
+    """
+    query_template = load_query_template()
+    # Replace the placeholder with the actual query, escaped so quotes cannot break the JSON
+    query_template_str = json.dumps(query_template)
+    query_template_str = query_template_str.replace("{query}", json.dumps(query_text)[1:-1])
+    return json.loads(query_template_str)
+
+
+def reranked_result(query_text, candidates):
+    """
+    Rerank candidate passages and return the picked ones in the shape of a search result.
+    """
+    import rerank
+    picked = rerank.rerank(query_text, candidates)
+    if not picked:
+        return "No documents matched the search."
+    return {"type": "search-result", "id": picked[0]["id"], "text": "\n\n".join(candidate["text"] for candidate in picked)}
+
+
 def search(query_text):
     """
     Search the Elasticsearch corpus using the user's query.
     """
     # Environment variables
-    ELASTICSEARCH_HOST = os.getenv("ELASTICSEARCH_HOST")
-    ELASTICSEARCH_API_KEY = os.getenv("ELASTICSEARCH_API_KEY")
     ELASTICSEARCH_INDEX = os.getenv("ELASTICSEARCH_INDEX")
     CONTEXT_FIELDS = os.getenv("CONTEXT_FIELDS", "content").split(",")  # Default to 'content' if not set
-
-    # Initialize Elasticsearch client
-    es = Elasticsearch(
-        ELASTICSEARCH_HOST,
-        api_key=ELASTICSEARCH_API_KEY
-    )
+    SEARCH_PROFILE_RATIO = float(os.getenv("SEARCH_PROFILE_RATIO", "0"))  # Share of searches to profile
+    # off, fallback (when the cluster is unreachable) or primary (small corpora), see local_search.py
+    LOCAL_SEARCH = os.getenv("LOCAL_SEARCH", "off").lower()
+    # Rerank a wider candidate set locally instead of taking the first hit
+    SEARCH_RERANK = os.getenv("SEARCH_RERANK", "false").lower() == "true"
 
     try:
-        # Load the query template
-        query_template = load_query_template()
+        # The local index needs no cluster, so answer before any client is created
+        if LOCAL_SEARCH == "primary":
+            return search_local(query_text)
+
+        # The shared Elasticsearch client
+        es = get_client()
+
+        # Load the query template with the query filled in
+        query_template = build_query(query_text)
+        # Ask for a wider set of passages to rerank locally, see rerank.py
+        if SEARCH_RERANK:
+            import rerank
+            rerank.widen_query(query_template, CONTEXT_FIELDS)
 
-        # Replace the placeholder with the actual query
-        query_template_str = json.dumps(query_template)
-        query_template_str = query_template_str.replace("{query}", query_text)
-        query_template = json.loads(query_template_str)
+        # Profile a sample of the searches to see where Elasticsearch spends its time
+        profiled = random.random() < SEARCH_PROFILE_RATIO
+        if profiled:
+            query_template["profile"] = True
 
-        # Perform the search
-        search_results = es.search(index=ELASTICSEARCH_INDEX, body=query_template)
+        # Perform the search, timing the round trip so we can compare it with the time
+        # Elasticsearch reports it spent on the search. The headers tie the request to this
+        # trace in the Elasticsearch slow log and task list.
+        start = time.perf_counter()
+        search_results = es.options(headers=telemetry.elasticsearch_headers("search")).search(index=ELASTICSEARCH_INDEX, body=query_template)
+        telemetry.record_search(search_results.get('took'), time.perf_counter() - start)
+        if profiled and search_results.get('profile'):
+            telemetry.record_search_profile(search_results['profile'])
 
 
         # Extract relevant information from search results
-        if search_results and search_results.get('hits', {}).get('hits'):
+        if SEARCH_RERANK:
+            result = reranked_result(query_text, rerank.candidates_from_hits(search_results, CONTEXT_FIELDS))
+        elif search_results and search_results.get('hits', {}).get('hits'):
             hit = search_results['hits']['hits'][0]
             document = hit.get('_source', {})
             document_id = hit.get('_id', 'Unknown')
@@ -96,7 +193,22 @@ def search(query_text):
                         context_parts.append(f"{field}: {value}")
                     else:
                         logger.warning(f"Field '{field}' is missing in the document.")
+    except (ConnectionError, ConnectionTimeout) as e:
+        if LOCAL_SEARCH != "fallback":
+            logger.error(f"An error occurred during the search: {e}")
+            telemetry.record_tool_error("search", type(e).__name__)
+            return "An error occurred during the search. Please try again later."
+        # The cluster cannot be reached, answer from the local index instead
+        logger.warning(f"Elasticsearch is unreachable, using the local index: {e}")
+        trace.get_current_span().set_attribute("search.fallback", True)
+        try:
+            result = search_local(query_text)
+        except Exception as local_error:
+            logger.error(f"An error occurred during the local search: {local_error}")
+            telemetry.record_tool_error("search", type(local_error).__name__)
+            result = "An error occurred during the search. Please try again later."
     except Exception as e:
         logger.error(f"An error occurred during the search: {e}")
+        telemetry.record_tool_error("search", type(e).__name__)
         result = "An error occurred during the search. Please try again later."
     return result
@@ -0,0 +1,381 @@
+# local_search.py
+
+"""
+Embedded BM25 search engine, a fallback and low-latency tier for the `search` function.
+
+Every `search()` used to need the Elasticsearch cluster, so a network blip failed the turn
+and even the small `pdfs/` corpus paid a network round trip. This module keeps a lexical
+index of the same extracted text in the process:
+
+- Documents are the text the `pdf-pipeline` ingest pipeline extracts (`attachment.content`),
+  read from JSON files such as `pdfs/alice.json` or dumped from the Elasticsearch index.
+  PDF files are not read directly, there is no PDF text extraction here: to search the
+  bundled PDFs (e.g. the Sherlock Holmes stories) index them with
+  `pdf-upload-tools/index-pdfs.py` and build with `--from-index`.
+  They are split into overlapping passages of LOCAL_SEARCH_CHUNK_WORDS words, like the
+  chunks semantic_text makes.
+- The index is one file of flat NumPy arrays (term offsets, postings of passage ids and term
+  frequencies, passage lengths and the passage text) behind a JSON header. It is memory
+  mapped, so opening it is instant and the pages are shared between processes.
+- BM25 is scored for all query terms at once with NumPy, and results have the same shape as
+  the semantic `search()` result: `{"type": "search-result", "id": ..., "text": ...}`.
+
+`search()` uses it when LOCAL_SEARCH=primary (small corpora) or, with LOCAL_SEARCH=fallback,
+when the cluster cannot be reached.
+
+Usage:
+    python local_search.py build pdfs/*.json          # from extracted JSON files
+    python local_search.py build --from-index         # from ELASTICSEARCH_INDEX
+    python local_search.py query "white rabbit"
+    python local_search.py bench                      # local index vs Elasticsearch searches
+"""
+
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import argparse
+import threading
+from collections import Counter
+
+import numpy as np
+
+
+LOCAL_SEARCH_INDEX = os.getenv("LOCAL_SEARCH_INDEX", "local_index/bm25.idx")
+LOCAL_SEARCH_CHUNK_WORDS = int(os.getenv("LOCAL_SEARCH_CHUNK_WORDS", "250"))
+LOCAL_SEARCH_CHUNK_OVERLAP = int(os.getenv("LOCAL_SEARCH_CHUNK_OVERLAP", "50"))
+
+MAGIC = b"BM25IDX1"
+ALIGNMENT = 8
+# Elasticsearch's BM25 defaults
+K1 = 1.2
+B = 0.75
+
+STOPWORDS = frozenset(
+    "a an and are as at be but by for if in into is it no not of on or such that the their then "
+    "there these they this to was will with".split()
+)
+TOKEN_PATTERN = re.compile(r"\w+")
+
+# Queries used by `bench` when no queries file is given
+BENCHMARK_QUERIES = [
+    "white rabbit with a pocket watch",
+    "the Queen of Hearts croquet",
+    "Mad Hatter tea party",
+    "Irene Adler photograph",
+    "red-headed league advertisement",
+    "King of Bohemia",
+]
+
+
+def tokenize(text):
+    """
+    Split text into lower case terms, dropping stopwords.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def chunk_text(text, words=LOCAL_SEARCH_CHUNK_WORDS, overlap=LOCAL_SEARCH_CHUNK_OVERLAP):
+    """
+    Split text into passages of `words` words, each overlapping the previous one by `overlap` words.
+    """
+    tokens = text.split()
+    step = max(1, words - overlap)
+    return [" ".join(tokens[start:start + words]) for start in range(0, max(1, len(tokens) - overlap), step)]
+
+
+def _aligned(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def build_index(documents, path=LOCAL_SEARCH_INDEX):
+    """
+    Build the index file from documents.
+
+    Args:
+        documents (iterable): (document id, text) pairs.
+        path (str): The index file to write.
+
+    Returns:
+        dict: The header of the index, with the document and passage counts.
+    """
+    doc_ids = []
+    chunk_docs = []
+    chunk_lengths = []
+    texts = []
+    vocabulary = {}
+    posting_terms = []
+    posting_chunks = []
+    posting_tfs = []
+    for doc_id, text in documents:
+        doc_number = len(doc_ids)
+        doc_ids.append(doc_id)
+        for chunk in chunk_text(text):
+            chunk_id = len(texts)
+            tokens = tokenize(chunk)
+            texts.append(chunk.encode("utf-8"))
+            chunk_docs.append(doc_number)
+            chunk_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                posting_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                posting_chunks.append(chunk_id)
+                posting_tfs.append(tf)
+
+    # Group the postings by term, keeping them in passage order within a term
+    posting_terms = np.array(posting_terms, dtype=np.int32)
+    order = np.argsort(posting_terms, kind="stable")
+    term_counts = np.bincount(posting_terms, minlength=len(vocabulary))
+    offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(term_counts, out=offsets[1:])
+    chunk_count = len(texts)
+    idf = np.log(1 + (chunk_count - term_counts + 0.5) / (term_counts + 0.5)).astype(np.float32)
+    text_offsets = np.zeros(chunk_count + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+
+    arrays = {
+        "offsets": offsets,
+        "postings_chunks": np.array(posting_chunks, dtype=np.int32)[order],
+        "postings_tf": np.minimum(np.array(posting_tfs, dtype=np.int64), np.iinfo(np.uint16).max).astype(np.uint16)[order],
+        "idf": idf,
+        "chunk_lengths": np.array(chunk_lengths, dtype=np.int32),
+        "chunk_docs": np.array(chunk_docs, dtype=np.int32),
+        "text_offsets": text_offsets,
+        "text": np.frombuffer(b"".join(texts), dtype=np.uint8),
+    }
+    header = {
+        "documents": len(doc_ids),
+        "chunks": chunk_count,
+        "average_length": float(np.mean(chunk_lengths)) if chunk_lengths else 0.0,
+        "doc_ids": doc_ids,
+        "vocabulary": sorted(vocabulary, key=vocabulary.get),
+    }
+    _write(path, header, arrays)
+    return header
+
+
+def _write(path, header, arrays):
+    """
+    Write the header and the arrays, each aligned to 8 bytes, to one file.
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "count": int(array.size), "offset": offset}
+        offset += _aligned(array.nbytes)
+    header = dict(header, arrays=layout)
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(header_bytes))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Write to a temporary file and rename, so a running process never sees half an index
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(MAGIC)
+        file.write(len(header_bytes).to_bytes(8, "little"))
+        file.write(header_bytes)
+        file.write(b"\0" * (data_start - file.tell()))
+        for array in arrays.values():
+            file.write(np.ascontiguousarray(array).tobytes())
+            file.write(b"\0" * (_aligned(array.nbytes) - array.nbytes))
+    os.replace(temporary, path)
+
+
+class LocalIndex:
+    """
+    A memory mapped BM25 index.
+
+    Args:
+        path (str): The index file written by `build_index()`.
+    """
+
+    def __init__(self, path=LOCAL_SEARCH_INDEX):
+        self.path = path
+        with open(path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a local search index")
+            header_length = int.from_bytes(file.read(8), "little")
+            header = json.loads(file.read(header_length))
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        data_start = _aligned(len(MAGIC) + 8 + header_length)
+        for name, spec in header["arrays"].items():
+            array = np.frombuffer(self.buffer, dtype=np.dtype(spec["dtype"]), count=spec["count"], offset=data_start + spec["offset"])
+            setattr(self, name, array)
+        self.doc_ids = header["doc_ids"]
+        self.chunk_count = header["chunks"]
+        self.terms = {term: term_id for term_id, term in enumerate(header["vocabulary"])}
+        # The length part of the BM25 denominator only depends on the passage, so compute it once
+        average_length = header["average_length"] or 1.0
+        self.length_norm = (K1 * (1 - B + B * self.chunk_lengths / average_length)).astype(np.float32)
+
+    def passage(self, chunk_id):
+        """
+        Return the text of a passage.
+        """
+        start, end = self.text_offsets[chunk_id], self.text_offsets[chunk_id + 1]
+        return self.text[start:end].tobytes().decode("utf-8")
+
+    def scores(self, query_text):
+        """
+        Return the BM25 score of every passage for a query.
+        """
+        term_ids = [self.terms[term] for term in set(tokenize(query_text)) if term in self.terms]
+        if not term_ids:
+            return np.zeros(self.chunk_count, dtype=np.float32)
+        # Gather the postings of every query term and score them in one pass
+        ranges = [np.arange(self.offsets[term_id], self.offsets[term_id + 1]) for term_id in term_ids]
+        positions = np.concatenate(ranges)
+        idf = np.repeat(self.idf[term_ids], [len(r) for r in ranges])
+        chunks = self.postings_chunks[positions]
+        tf = self.postings_tf[positions].astype(np.float32)
+        contributions = idf * tf * (K1 + 1) / (tf + self.length_norm[chunks])
+        return np.bincount(chunks, weights=contributions, minlength=self.chunk_count)
+
+    def search(self, query_text, k=10):
+        """
+        Return the top `k` passages for a query.
+
+        Returns:
+            list: Hits with the document `id`, the BM25 `score` and the passage `text`, best first.
+        """
+        scores = self.scores(query_text)
+        k = min(k, self.chunk_count)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {"id": self.doc_ids[self.chunk_docs[chunk_id]], "score": float(scores[chunk_id]), "text": self.passage(chunk_id)}
+            for chunk_id in top if scores[chunk_id] > 0
+        ]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    Return the shared index, opening LOCAL_SEARCH_INDEX on first use.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = LocalIndex(LOCAL_SEARCH_INDEX)
+    return _index
+
+
+def search_result(query_text):
+    """
+    Search the local index, returning the best passage in the same shape as `search()`.
+    """
+    hits = get_index().search(query_text, k=1)
+    if not hits:
+        return "No documents matched the search."
+    return {"type": "search-result", "id": hits[0]["id"], "text": hits[0]["text"]}
+
+
+def documents_from_files(paths):
+    """
+    Read documents from JSON files holding the extracted `attachment`, e.g. pdfs/alice.json.
+    """
+    for path in paths:
+        with open(path, "r") as file:
+            document = json.load(file)
+        text = document.get("attachment", {}).get("content") or document.get("content", "")
+        yield document.get("file_name", os.path.basename(path)), text
+
+
+def documents_from_index(es, index):
+    """
+    Read the extracted text of every document in an Elasticsearch index.
+    """
+    from elasticsearch import helpers
+    for hit in helpers.scan(es, index=index, _source=["attachment.content"]):
+        yield hit["_id"], hit["_source"].get("attachment", {}).get("content", "")
+
+
+def benchmark(queries, repeat):
+    """
+    Time the local index against the same query template sent to Elasticsearch.
+
+    The Elasticsearch searches go to the client directly rather than through `search()`,
+    which answers a failed search with an error message in no time. Any failure stops the
+    benchmark instead of being timed.
+    """
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import telemetry
+    from llm_functions import search as search_function
+    es = search_function.get_client()
+    es_index = os.getenv("ELASTICSEARCH_INDEX")
+
+    index = get_index()
+    engines = {
+        "local": lambda query: index.search(query, k=1),
+        "elasticsearch": lambda query: es.search(index=es_index, body=search_function.build_query(query)),
+    }
+    for name, run in engines.items():
+        latencies = []
+        for _ in range(repeat):
+            for query in queries:
+                start = time.perf_counter()
+                try:
+                    run(query)
+                except Exception as e:
+                    sys.exit(f"{name} search for '{query}' failed, not benchmarking: {type(e).__name__}: {e}")
+                latencies.append(time.perf_counter() - start)
+        p50, p95 = telemetry.percentile(latencies, 0.50), telemetry.percentile(latencies, 0.95)
+        print(f"{name:<14} p50 {p50 * 1000:8.2f} ms  p95 {p95 * 1000:8.2f} ms  ({len(latencies)} searches)")
+
+
+def main():
+    """
+    Build, query or benchmark the local index.
+    """
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="./config/.env", override=True)
+    global LOCAL_SEARCH_INDEX
+    LOCAL_SEARCH_INDEX = os.getenv("LOCAL_SEARCH_INDEX", LOCAL_SEARCH_INDEX)
+
+    parser = argparse.ArgumentParser(description="Build, query or benchmark the local BM25 index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Build the index")
+    build.add_argument("files", nargs="*", help="JSON files with the extracted attachment, e.g. pdfs/alice.json (not PDFs, use --from-index for those)")
+    build.add_argument("--from-index", action="store_true", help="Read the documents from ELASTICSEARCH_INDEX instead")
+    query = commands.add_parser("query", help="Search the index")
+    query.add_argument("text")
+    query.add_argument("-k", type=int, default=3)
+    bench = commands.add_parser("bench", help="Compare the latency of the local index and Elasticsearch")
+    bench.add_argument("--queries", help="File with one query per line")
+    bench.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if args.from_index:
+            from elasticsearch import Elasticsearch
+            es = Elasticsearch(os.getenv("ELASTICSEARCH_HOST"), api_key=os.getenv("ELASTICSEARCH_API_KEY"))
+            documents = documents_from_index(es, os.getenv("ELASTICSEARCH_INDEX"))
+        else:
+            pdfs = [path for path in args.files if path.lower().endswith(".pdf")]
+            if pdfs:
+                parser.error(f"PDF files cannot be read directly ({', '.join(pdfs)}), index them with "
+                             "pdf-upload-tools/index-pdfs.py and build with --from-index")
+            documents = documents_from_files(args.files)
+        start = time.perf_counter()
+        header = build_index(documents, LOCAL_SEARCH_INDEX)
+        print(f"Indexed {header['documents']} documents as {header['chunks']} passages ({len(header['vocabulary'])} terms) "
+              f"in {time.perf_counter() - start:.2f}s, {os.path.getsize(LOCAL_SEARCH_INDEX) / 1e6:.1f} MB at {LOCAL_SEARCH_INDEX}")
+    elif args.command == "query":
+        for hit in get_index().search(args.text, k=args.k):
+            print(f"{hit['score']:7.2f}  {hit['id']}  {hit['text'][:100]}")
+    else:
+        queries = BENCHMARK_QUERIES
+        if args.queries:
+            with open(args.queries, "r") as file:
+                queries = [line.strip() for line in file if line.strip()]
+        benchmark(queries, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -46,20 +46,32 @@ import logging
 import json
 import argparse
 import pprint
+import time
+import uuid
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 import openai
 
+# Load the configuration before anything else so the modules below can read it at import time
+load_dotenv(dotenv_path="./config/.env", override=True)
+
 ############################################
 # OpenTelemetry setup
 ############################################
 from opentelemetry import trace
+import telemetry
+import profiler
 # Init tracer
 tracer = trace.get_tracer_provider().get_tracer(__name__)
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger()
+# Only export the traces worth keeping if TELEMETRY_TAIL_SAMPLING is set
+telemetry.install_tail_sampling()
+# Sample stacks and tie them to traces if PROFILER_ENABLED is set
+profiler.start_from_env()
 
 ############################################
 # Import functions we can expose to the LLM
@@ -68,11 +80,22 @@ import llm_functions
 from pkgutil import iter_modules
 import pickle
 import art
+import atexit
+import audit
+import result_encoding
+import tool_selection
+import model_router
+import rate_limiter
+import prompt_prefix
+import warmup
 
 # Every file in the foler is loaded as a seperate function.
 # The function name is the same as the file name
 function_definitions = []
 function_functions = {}
+function_keywords = {}
+function_direct_returns = {}
+function_warm_ups = {}
 for submodule in iter_modules(getattr(llm_functions,"__path__")):
         if submodule.ispkg:
             pass
@@ -83,13 +106,25 @@ for submodule in iter_modules(getattr(llm_functions,"__path__")):
             name = submodule.name
             function = getattr(mod,submodule.name)
             function_functions[name] = function
+            # Optional keywords used to decide when to send the definition, see tool_selection.py
+            function_keywords[name] = getattr(mod, "keywords", [])
+            # Functions whose result is shown to the user as is, formatted with a template
+            if getattr(mod, "direct_return", False):
+                function_direct_returns[name] = getattr(mod, "direct_return_template", "{result}")
+            # Optional set up (connections, heavy imports) run in the background at startup, see warmup.py
+            if hasattr(mod, "warm_up"):
+                function_warm_ups[name] = getattr(mod, "warm_up")
+
+# Sorted and canonically serialised once, so the prompt prefix is byte-identical on every call
+function_definitions = prompt_prefix.canonical_definitions(function_definitions)
+
+# Only the definitions relevant to a turn are sent to the LLM
+tool_selector = tool_selection.ToolSelector(function_definitions, function_keywords)
 
 
 ############################################
 # Load the configuration from the .env file
 ############################################
-load_dotenv(dotenv_path="./config/.env", override=True)
-
 ASSISTANT_NAME = os.getenv("ASSISTANT_NAME")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -99,13 +134,33 @@ AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
 AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")  # e.g., "2023-05-15"
 CONTEXT_FIELDS = os.getenv("CONTEXT_FIELDS", "content")  # Default to 'content' if not set
+# Use the local stand-ins from stand_ins.py instead of the real services (e.g. for replay.py)
+LLM_STAND_IN = os.getenv("LLM_STAND_IN", "false").lower() == "true"
+TOOL_STAND_IN = os.getenv("TOOL_STAND_IN", "false").lower() == "true"
+# Stream completions so we can measure time to first token
+LLM_STREAM = os.getenv("LLM_STREAM", "false").lower() == "true"
+
+# Optional fast and strong deployments to route turns between, see model_router.py
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL")
+LLM_STRONG_MODEL = os.getenv("LLM_STRONG_MODEL")
+
+if TOOL_STAND_IN:
+    import stand_ins
+    logger.info("Using local stand-ins for the functions")
+    for name in function_functions:
+        function_functions[name] = stand_ins.stand_in_tool(name)
 
 
 ############################################
 # Azure OpenAI setup
 ############################################
 ############################################
-if OPENAI_API_KEY:
+if LLM_STAND_IN:
+    import stand_ins
+    logger.info("Using the local LLM stand-in")
+    AZURE_OPENAI_DEPLOYMENT_NAME = AZURE_OPENAI_DEPLOYMENT_NAME or OPENAI_MODEL or "stand-in"
+    client = stand_ins.StandInClient()
+elif OPENAI_API_KEY:
     logger.info("Using OpenAI")
     obscured_api_key = OPENAI_API_KEY[:4] + "*" * (len(OPENAI_API_KEY) - 8) + OPENAI_API_KEY[-4:]
     logger.info(f"OpenAI API Key: {obscured_api_key}")
@@ -113,53 +168,71 @@ if OPENAI_API_KEY:
         logger.info(f"OpenAI Base URL: {OPENAI_BASE_URL}")
     assert OPENAI_MODEL, "OPENAI_MODEL environment variable is not set"
     AZURE_OPENAI_DEPLOYMENT_NAME = OPENAI_MODEL
-    if OPENAI_BASE_URL:
-
-        client = openai.Client(api_key=OPENAI_API_KEY)
-        client.base_url = OPENAI_BASE_URL
-        chat_completion = client.chat.completions.create(
-            model="gpt-4o", 
-            messages=[
-                {"role": "user", "content": "Hello world"}
-                ]
-        )
-    else:
-        client = openai.Client(api_key=OPENAI_API_KEY)
+    # The credentials are checked by the background warm-up below rather than a blocking call here.
+    # The SDK's own retries are off: llm_limiter retries 429s and transient failures (see rate_limiter.py)
+    client = openai.Client(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None, max_retries=0)
 else:
     logger.info("Using Azure OpenAI")
     client = AzureOpenAI(
         azure_endpoint=AZURE_OPENAI_ENDPOINT,
         api_version=AZURE_OPENAI_API_VERSION,
-        api_key=AZURE_OPENAI_API_KEY
+        api_key=AZURE_OPENAI_API_KEY,
+        # llm_limiter owns the retries, see above
+        max_retries=0
     )
 
 
+# Check the credentials, open the connections and import the heavy tools in the background
+# so the prompt appears straight away and the first turn is as fast as the later ones
+warmup.start(
+    client=None if LLM_STAND_IN else client,
+    tool_warm_ups=None if TOOL_STAND_IN else function_warm_ups
+)
+
+# Every LLM call of every session goes through one limiter, see rate_limiter.py
+llm_limiter = rate_limiter.RateLimiter()
+
+# Both routes default to the configured deployment, which disables routing
+router = model_router.ModelRouter(
+    fast_model=LLM_FAST_MODEL or AZURE_OPENAI_DEPLOYMENT_NAME,
+    strong_model=LLM_STRONG_MODEL or AZURE_OPENAI_DEPLOYMENT_NAME
+)
+
+
 ############################################
 # Chat application global variables
 ############################################
 user_name = None
 messages = []
+# Identifies the conversation in the audit log, so replay.py can tell sessions of the same user apart
+session_id = uuid.uuid4().hex
+# Audit records are written by a background thread, see audit.py
+audit_sink = audit.AuditSink()
+atexit.register(audit_sink.close)
 # Initialise the message list
+# The system prompt is part of the cached prompt prefix, keep anything volatile (e.g. the time) out of it
 with open("./config/system_prompt.txt", "r") as file:
-    system_prompt = file.read().strip()
+    system_prompt = prompt_prefix.canonical_system_prompt(file.read())
 messages.append({
     "role": "system",
     "content": system_prompt
 })
 
 
-def print_pretty_response(response):
+def print_pretty_response(response, history=None):
     """
     Print the response in a pretty format.
 
     Args:
         response (str): The response to print.
+        history (list): The conversation to add the response to. Defaults to the global messages.
 
     Returns:
         None
     """
-    global messages
-    messages.append({
+    if history is None:
+        history = messages
+    history.append({
         "role": "assistant",
         "content": response
     })
@@ -167,7 +240,133 @@ def print_pretty_response(response):
     print("-"*50)
 
 
-def chat(user_input):
+def new_conversation():
+    """
+    Start a new conversation history containing only the system prompt.
+
+    Returns:
+        list: The messages list for a new conversation.
+    """
+    return [{
+        "role": "system",
+        "content": system_prompt
+    }]
+
+
+def collect_stream(stream, start):
+    """
+    Assemble a streamed completion into the same shape as a non-streamed response.
+
+    Args:
+        stream: The chunks returned by `client.chat.completions.create(stream=True)`.
+        start (float): The `time.perf_counter()` value when the request was sent.
+
+    Returns:
+        tuple: The assembled response and the time to the first token in seconds.
+    """
+    content = []
+    function_name = None
+    function_arguments = []
+    finish_reason = None
+    usage = None
+    model = None
+    time_to_first_token = None
+    for chunk in stream:
+        model = getattr(chunk, "model", None) or model
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        # Azure sends chunks without choices, e.g. for content filter results
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        delta = choice.delta
+        if time_to_first_token is None and (delta.content or delta.function_call):
+            time_to_first_token = time.perf_counter() - start
+        if delta.content:
+            content.append(delta.content)
+        if delta.function_call:
+            if delta.function_call.name:
+                function_name = delta.function_call.name
+            if delta.function_call.arguments:
+                function_arguments.append(delta.function_call.arguments)
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+
+    function_call = None
+    if function_name:
+        function_call = SimpleNamespace(name=function_name, arguments="".join(function_arguments))
+    message = SimpleNamespace(role="assistant", content="".join(content) if content else None, function_call=function_call)
+    choice = SimpleNamespace(index=0, finish_reason=finish_reason, message=message)
+    return SimpleNamespace(model=model, choices=[choice], usage=usage), time_to_first_token
+
+
+def call_llm(history, functions=None, model=None, route=None):
+    """
+    Send the conversation to the LLM and record the latency and token usage.
+
+    Args:
+        history (list): The conversation to send.
+        functions (list): The function definitions to send. Defaults to all of them.
+        model (str): The deployment to call. Defaults to AZURE_OPENAI_DEPLOYMENT_NAME.
+        route (str): The route chosen by the model router, recorded with the metrics.
+
+    Returns:
+        The completion response.
+    """
+    if functions is None:
+        functions = function_definitions
+    if model is None:
+        model = AZURE_OPENAI_DEPLOYMENT_NAME
+    # manual opentelemetry span creation
+    with tracer.start_as_current_span("call_llm") as span:
+        # Calls with the same prefix fingerprint can be served from the provider's prompt cache
+        span.set_attribute("llm.prompt_prefix", prompt_prefix.fingerprint(system_prompt, functions))
+        timings = {}
+        # The API rejects an empty functions list, leave it out when no function was selected
+        function_options = {"functions": functions} if functions else {}
+
+        def send():
+            start = time.perf_counter()
+            time_to_first_token = None
+            # The raw response gives us the rate limit headers, the stand-in has none
+            completions = getattr(client.chat.completions, "with_raw_response", None)
+            create = completions.create if completions else client.chat.completions.create
+            if LLM_STREAM:
+                response = create(
+                                    model=model,
+                                    messages=history,
+                                    stream=True,
+                                    stream_options={"include_usage": True},
+                                    **function_options
+                            )
+                headers = response.headers if completions else {}
+                stream = response.parse() if completions else response
+                response, time_to_first_token = collect_stream(stream, start)
+            else:
+                response = create(
+                                    model=model,
+                                    messages=history,
+                                    stream=False,
+                                    **function_options
+                            )
+                headers = response.headers if completions else {}
+                response = response.parse() if completions else response
+            timings["duration"] = time.perf_counter() - start
+            timings["time_to_first_token"] = time_to_first_token
+            return response, headers
+
+        estimated_tokens = result_encoding.estimate_tokens(json.dumps(history) + json.dumps(functions)) + rate_limiter.LLM_COMPLETION_TOKENS_ESTIMATE
+        try:
+            # Sessions are told apart by their history list
+            response = llm_limiter.call(send, session=id(history), estimated_tokens=estimated_tokens)
+        except Exception as e:
+            telemetry.record_llm_error(model, e)
+            raise
+        telemetry.record_llm_call(model, timings["duration"], response.usage, timings["time_to_first_token"], route)
+    return response
+
+
+def chat(user_input, history=None, user=None, session=None):
     """
     Chat with the user.
 
@@ -189,28 +388,38 @@ def chat(user_input):
 
     Args:
         user_input (str): The input provided by the user.
+        history (list): The conversation to continue. Defaults to the global messages,
+            pass a list from `new_conversation()` to run several sessions side by side.
+        user (str): The name of the user. Defaults to the global user_name.
+        session (str): The id of the conversation in the audit log. Defaults to the global session_id.
 
     Returns:
         str: The response generated by the Azure OpenAI service.
     """
-    global messages
     global logger
-    messages.append({
+    if history is None:
+        history = messages
+    if user is None:
+        user = user_name
+    if session is None:
+        session = session_id
+    history.append({
         "role": "user",
         "content": user_input
     })
 
+    # Pick the functions for this turn once, the follow-up calls in the loop use the same ones
+    functions, tokens_saved = tool_selector.select(user_input, history)
+    current_span = trace.get_current_span()
+    current_span.set_attribute("tools.selected", [definition["name"] for definition in functions])
+    current_span.set_attribute("tools.definition_tokens_saved", tokens_saved)
+    # Pick the fast or strong deployment for this turn
+    route = router.route(user_input, history, tool_selector.matched(user_input))
+
     user_reply = False
     while user_reply == False:
         reference_doc_id = None
-        # manual opentelemetry span creation
-        with tracer.start_as_current_span("call_llm"):
-            response = client.chat.completions.create(
-                                model=AZURE_OPENAI_DEPLOYMENT_NAME,
-                                messages=messages,
-                                stream=False,
-                                functions= function_definitions
-                        )
+        response = call_llm(history, functions, route.model, route.name)
         choice = response.choices[0]
         if choice.finish_reason == "function_call":
             function_call = choice.message.function_call
@@ -218,9 +427,9 @@ def chat(user_input):
             function_args = function_call.arguments
             if isinstance(function_args, str):
                 function_args = json.loads(function_args)
-            print_pretty_response(f"Calling {function_name} with arguments: {function_args}")
+            print_pretty_response(f"Calling {function_name} with arguments: {function_args}", history)
 
-            logger.info(f"Calling function {function_name} with arguments: {function_args}")
+            logger.info(f"Calling function {function_name} with arguments: {telemetry.limit_text(str(function_args))}")
             # We will add a manual span with the name of the function being called
             # this way we can track the time spent in each function
 
@@ -228,12 +437,26 @@ def chat(user_input):
             ############################
             # LAB: Improve tracing
             ############################
-            # Hint: Add a manual span for each function call
-            #with tracer.start_as_current_span(function_name):
-            if True: # this is a placeholder for the manual span comment this if you uncomment the trace line
-                function = function_functions[function_name]
-                response = function(**function_args)
-            messages.append(
+            # A manual span for each function call, replay.py uses these for its per-span breakdown
+            with tracer.start_as_current_span(function_name) as function_span:
+                with telemetry.measure_tool(function_name):
+                    function = function_functions[function_name]
+                    response = function(**function_args)
+                # Functions can ask for their result to go straight to the user
+                direct_text = None
+                if isinstance(response, llm_functions.DirectReturn):
+                    template = response.template or function_direct_returns.get(function_name, "{result}")
+                    response = response.value
+                    direct_text = template.format(result=response)
+                elif function_name in function_direct_returns and response is not None:
+                    direct_text = function_direct_returns[function_name].format(result=response)
+                function_span.set_attribute("tool.direct_return", direct_text is not None)
+                # Compact JSON keeps the result small for every later call in the session,
+                # the saving against the old repr encoding is only measured for sampled spans
+                function_content, encoding_stats = result_encoding.encode_tool_result(response, compare=function_span.is_recording())
+                for key, value in encoding_stats.items():
+                    function_span.set_attribute(f"tool.result.{key}", value)
+            history.append(
                 {
                     "role": "assistant",
                     "content": None,
@@ -243,19 +466,28 @@ def chat(user_input):
                     },
                 }
             )
-            messages.append(
+            history.append(
                 {
                     "role": "function", 
                     "name": function_name, 
-                    "content": f'{{"result": {str(response)} }}'}
+                    "content": function_content}
             )
             if isinstance(response, dict) and "type" in response and response["type"] == "search-result":
                 # HINT: *cough* audit log *cough*
                 reference_doc_id = response["id"]
+            if direct_text is not None:
+                # The result needs no rewording, answer without another LLM call
+                user_reply = True
+                user_response = direct_text
         else:
+            if router.should_escalate(route, user_input, choice.message.content):
+                # The fast model's answer does not look good enough, ask the strong one
+                route = router.escalate(route)
+                continue
             user_reply = True
             user_response = choice.message.content
 
+        if user_reply:
             ############################
             # LAB: Audit log
             ############################
@@ -267,15 +499,16 @@ def chat(user_input):
             #print("Response datastructure:")
             #print(response.model_dump_json(indent=3))
 
-            audit_message = f'User {user_name} asked {user_input}'
+            audit_message = f'User {user} asked {telemetry.limit_text(user_input)}'
             audit_context = {}
-            audit_context['user_name'] = user_name
-            audit_context['reply'] = user_response
-            audit_context['query'] = user_input
+            audit_context['user_name'] = user
+            audit_context['session_id'] = session
+            audit_context['reply'] = telemetry.limit_text(user_response)
+            audit_context['query'] = telemetry.limit_text(user_input)
             audit_context['doc_references'] = [] # Hint scroll up
             # TODO: maybe we should add more info about the model used and tokens?
 
-            logger.info(audit_message,extra=audit_context)
+            audit_sink.emit(audit_message, audit_context)
 
             ############################
             # LAB: Add events to the trace
@@ -287,9 +520,9 @@ def chat(user_input):
             current_span.add_event(
                 "User interaction",
                 {
-                    "user_name": user_name,
-                    "user_input": user_input,
-                    "response": user_response,
+                    "user_name": user,
+                    "user_input": telemetry.limit_text(user_input),
+                    "response": telemetry.limit_text(user_response),
                     "reference_doc_id": []
                 }
             )
@@ -379,6 +612,7 @@ def main():
         if user_input.lower() in ["exit", "quit"]:
             logger.info("User ended the chat")
             print_pretty_response("Goodbye!")
+            audit_sink.close()
             break
         else:
             # Generate a response using Azure OpenAI
@@ -0,0 +1,122 @@
+# model_router.py
+
+"""
+Route each turn to a fast or a strong LLM deployment.
+
+Saying "hi" or asking for the time does not need the same model as a multi-hop question
+over the corpus. `ModelRouter` classifies each turn locally, with no extra LLM call, and
+picks a deployment:
+
+- `fast` (LLM_FAST_MODEL) for short, simple turns early in the conversation
+- `strong` (LLM_STRONG_MODEL) for long or multi-part questions, questions that need the
+  corpus and deep conversations
+
+The classifier adds up a score from the length of the input, question words that usually
+need reasoning, whether search is likely to be needed and the number of turns so far.
+The weights are in `SIGNALS` and the threshold in ROUTER_STRONG_SCORE.
+
+If the fast model's answer looks inadequate (empty, very short for a long question, or an
+"I don't know"), the turn is escalated and asked again on the strong deployment when
+ROUTER_ESCALATION=true.
+
+Each decision, its reason and escalations are recorded on the span and as metrics, and the
+LLM latency metrics carry the route, so the weights can be tuned from real traffic.
+When the fast and strong deployments are the same routing is disabled.
+"""
+
+import os
+import re
+from collections import namedtuple
+
+import telemetry
+
+
+ROUTER_STRONG_SCORE = float(os.getenv("ROUTER_STRONG_SCORE", "2"))
+ROUTER_ESCALATION = os.getenv("ROUTER_ESCALATION", "true").lower() == "true"
+ROUTER_MIN_ANSWER_CHARS = int(os.getenv("ROUTER_MIN_ANSWER_CHARS", "40"))
+
+Route = namedtuple("Route", ["name", "model", "reason"])
+
+# (name, weight, test) - test gets the user input, the history and the names of the functions matched by keyword
+SIGNALS = [
+    ("long_input", 1.5, lambda text, history, tools: len(text) > 200),
+    ("multi_part", 1.0, lambda text, history, tools: text.count("?") > 1 or re.search(r"\b(and also|as well as|then)\b", text, re.IGNORECASE) is not None),
+    ("reasoning", 1.5, lambda text, history, tools: re.search(r"\b(why|how does|how did|compare|difference|explain|summari[sz]e|relationship|analy[sz]e)\b", text, re.IGNORECASE) is not None),
+    ("corpus", 1.0, lambda text, history, tools: "search" in tools and len(text.split()) > 6),
+    ("deep_history", 1.0, lambda text, history, tools: sum(1 for message in history if message.get("role") == "user") > 6),
+]
+
+# Phrases that suggest the fast model could not answer
+INADEQUATE_ANSWER = re.compile(r"\b(i don't know|i do not know|i'm not sure|i am not sure|i cannot answer|i can't answer|unable to answer|i can't help)\b", re.IGNORECASE)
+
+
+class ModelRouter:
+    """
+    Decide which deployment handles a turn.
+
+    Args:
+        fast_model (str): The fast, cheap deployment.
+        strong_model (str): The strong deployment.
+    """
+
+    def __init__(self, fast_model, strong_model):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.enabled = bool(fast_model) and bool(strong_model) and fast_model != strong_model
+
+    def route(self, user_input, history, matched):
+        """
+        Pick the route for a turn.
+
+        Args:
+            user_input (str): The user's input.
+            history (list): The conversation so far.
+            matched (list): The names of the functions whose keywords are in the input, from
+                `ToolSelector.matched()`. Not the selected functions, which always include the core set.
+
+        Returns:
+            Route: The route name, the deployment to call and the reason.
+        """
+        if not self.enabled:
+            return Route("default", self.strong_model or self.fast_model, "routing_disabled")
+        tools = set(matched)
+        score = 0.0
+        reasons = []
+        for name, weight, test in SIGNALS:
+            if test(user_input, history, tools):
+                score += weight
+                reasons.append(name)
+        if score >= ROUTER_STRONG_SCORE:
+            route = Route("strong", self.strong_model, ",".join(reasons))
+        else:
+            route = Route("fast", self.fast_model, ",".join(reasons) or "simple")
+        telemetry.record_route(route.name, route.reason)
+        return route
+
+    def should_escalate(self, route, user_input, answer):
+        """
+        Check whether an answer from the fast route should be redone on the strong route.
+
+        Args:
+            route (Route): The route that produced the answer.
+            user_input (str): The user's input.
+            answer (str): The answer from the LLM.
+
+        Returns:
+            bool: True if the turn should be escalated.
+        """
+        if not ROUTER_ESCALATION or route.name != "fast":
+            return False
+        if not answer or not answer.strip():
+            return True
+        if INADEQUATE_ANSWER.search(answer):
+            return True
+        # A very short answer to a long question
+        return len(answer) < ROUTER_MIN_ANSWER_CHARS and len(user_input) > 4 * ROUTER_MIN_ANSWER_CHARS
+
+    def escalate(self, route):
+        """
+        Return the strong route for an escalated turn.
+        """
+        telemetry.record_route_escalation(route.reason)
+        return Route("strong", self.strong_model, "escalated")
@@ -11,8 +11,12 @@ import argparse
 import json
 from tqdm import tqdm
 import time
+from opentelemetry import trace
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import telemetry
+
+tracer = trace.get_tracer(__name__)
 
 # Load environment variables
 dotenv.load_dotenv( override=True,dotenv_path="config/.env")
@@ -104,18 +108,22 @@ def index_pdfs(directory, allowed_extensions, es, index, pipeline, use_semantic_
                 file_path = os.path.join(root, file)
                 print(f"Indexing {file_path}...")
 
-                # Base64 encode the file
-                with open(file_path, "rb") as f:
-                    encoded_file = base64.b64encode(f.read()).decode("utf-8")
-
-                # Create JSON document to index in Elasticsearch
-                document = {
-                    "file_name": file,
-                    "data": encoded_file
-                }
-
-                # Index the document in Elasticsearch
-                es.index(index=index, pipeline=pipeline, body=document)
+                # One span per document, so the request carries a traceparent and its opaque id a trace id
+                with tracer.start_as_current_span("index_pdf") as span:
+                    span.set_attribute("file.name", file)
+                    # Base64 encode the file
+                    with open(file_path, "rb") as f:
+                        encoded_file = base64.b64encode(f.read()).decode("utf-8")
+
+                    # Create JSON document to index in Elasticsearch
+                    document = {
+                        "file_name": file,
+                        "data": encoded_file
+                    }
+
+                    # Index the document in Elasticsearch, the X-Opaque-Id names the file
+                    # so slow indexing shows up in the Elasticsearch logs and task list
+                    es.options(headers=telemetry.elasticsearch_headers("index-pdfs", file)).index(index=index, pipeline=pipeline, body=document)
 
                 # Update the progress bar
                 progress_bar.update(1)
@@ -0,0 +1,208 @@
+# profiler.py
+
+"""
+Opt-in, low-overhead sampling profiler that ties Python stacks to traces.
+
+A slow span tells us which step of a turn was slow but not which Python code was hot.
+The profiler answers that without attaching external tools:
+
+- A timer thread samples the stack of every thread each PROFILER_INTERVAL seconds
+  using `sys._current_frames()`, so there is no per-call overhead like a tracing profiler.
+- `ProfilerSpanProcessor` remembers which span is active on each thread (span processors
+  are called on the thread that starts and ends the span), so every sample is tagged with
+  the trace and span it belongs to.
+- Samples are aggregated into collapsed stacks (`frame;frame;frame count`), the format
+  used by flamegraph.pl, speedscope and Elastic's flamegraph tooling. The first frame is
+  the name of the active span.
+- When a trace takes longer than PROFILER_SLOW_TRACE_SECONDS its stacks are written to
+  `PROFILER_OUTPUT_DIR/<trace id>.collapsed`. Sending SIGUSR1 to the process writes all
+  samples collected so far to `PROFILER_OUTPUT_DIR/on-demand-<time>.collapsed`.
+
+Enable it with PROFILER_ENABLED=true.
+"""
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+
+
+logger = logging.getLogger()
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "false").lower() == "true"
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.01"))
+PROFILER_SLOW_TRACE_SECONDS = float(os.getenv("PROFILER_SLOW_TRACE_SECONDS", "5"))
+PROFILER_OUTPUT_DIR = os.getenv("PROFILER_OUTPUT_DIR", "profiles")
+PROFILER_MAX_TRACES = 1000
+
+
+class ProfilerSpanProcessor(SpanProcessor):
+    """
+    Span processor that tracks the active span of each thread for the profiler.
+    """
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def on_start(self, span, parent_context=None):
+        stack = self.profiler.thread_spans.setdefault(threading.get_ident(), [])
+        stack.append(span)
+
+    def on_end(self, span):
+        stack = self.profiler.thread_spans.get(threading.get_ident(), [])
+        if span in stack:
+            stack.remove(span)
+        if span.parent is None or span.parent.is_remote:
+            self.profiler.trace_finished(span)
+
+
+class SamplingProfiler:
+    """
+    Timer based stack sampler that aggregates collapsed stacks per trace.
+
+    Args:
+        interval (float): Seconds between samples.
+        slow_seconds (float): Traces longer than this have their stacks written out.
+        output_dir (str): Where to write the collapsed stack files.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL, slow_seconds=PROFILER_SLOW_TRACE_SECONDS, output_dir=PROFILER_OUTPUT_DIR):
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.output_dir = output_dir
+        self.thread_spans = {}
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()
+        self.all_samples = Counter()
+        self.labels = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start sampling in a background thread.
+        """
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling.
+        """
+        self.running = False
+        if self.thread:
+            self.thread.join()
+
+    def _label(self, code):
+        """
+        Return the frame label for a code object, cached as formatting is the costly part.
+        """
+        label = self.labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self.labels[code] = label
+        return label
+
+    def _run(self):
+        """
+        Sampling loop.
+        """
+        own_id = threading.get_ident()
+        while self.running:
+            started = time.perf_counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack = ";".join(reversed(frames))
+                try:
+                    span = self.thread_spans[thread_id][-1]
+                except (KeyError, IndexError):
+                    # No active span, or it ended while we were sampling
+                    span = None
+                with self.lock:
+                    self.all_samples[stack] += 1
+                    if span is not None:
+                        trace_id = span.context.trace_id
+                        samples = self.traces.get(trace_id)
+                        if samples is None:
+                            samples = self.traces[trace_id] = Counter()
+                            if len(self.traces) > PROFILER_MAX_TRACES:
+                                self.traces.popitem(last=False)
+                        samples[f"{span.name};{stack}"] += 1
+            # Keep the sampling rate steady regardless of how long sampling took
+            time.sleep(max(0.0, self.interval - (time.perf_counter() - started)))
+
+    def trace_finished(self, root_span):
+        """
+        Called when the root span of a trace ends, writes the stacks if the trace was slow.
+        """
+        with self.lock:
+            samples = self.traces.pop(root_span.context.trace_id, None)
+        duration = (root_span.end_time - root_span.start_time) / 1e9
+        if samples and duration >= self.slow_seconds:
+            trace_id = format(root_span.context.trace_id, "032x")
+            path = os.path.join(self.output_dir, f"{trace_id}.collapsed")
+            self._write(path, samples)
+            logger.info(f"Slow trace {trace_id} took {duration:.1f}s, stacks written to {path}")
+
+    def dump(self, path=None):
+        """
+        Write every sample collected so far.
+
+        Args:
+            path (str): The file to write, defaults to an on-demand file in the output directory.
+
+        Returns:
+            str: The path of the file written.
+        """
+        if path is None:
+            path = os.path.join(self.output_dir, f"on-demand-{time.strftime('%Y%m%d-%H%M%S')}.collapsed")
+        with self.lock:
+            samples = Counter(self.all_samples)
+        self._write(path, samples)
+        return path
+
+    def _write(self, path, samples):
+        """
+        Write samples as collapsed stacks, one `stack count` line each.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def start_from_env():
+    """
+    Start the profiler if PROFILER_ENABLED=true.
+
+    Returns:
+        SamplingProfiler: The running profiler, or None if it is not enabled.
+    """
+    if not PROFILER_ENABLED:
+        return None
+    profiler = SamplingProfiler()
+    provider = trace.get_tracer_provider()
+    if isinstance(provider, TracerProvider):
+        provider.add_span_processor(ProfilerSpanProcessor(profiler))
+    else:
+        logger.warning("Profiler samples will not be tagged with traces without the OpenTelemetry SDK tracer provider")
+    # SIGUSR1 writes the samples collected so far, only available on the main thread of Unix like systems
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signum, frame: logger.info(f"Profile written to {profiler.dump()}"))
+    profiler.start()
+    logger.info(f"Sampling profiler started, sampling every {profiler.interval * 1000:.0f} ms")
+    return profiler
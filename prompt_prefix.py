@@ -0,0 +1,82 @@
+# prompt_prefix.py
+
+"""
+Stable layout of the prompt prefix, so the provider's prompt cache can be hit.
+
+OpenAI and Azure OpenAI cache the longest prefix of a prompt (from 1024 tokens, in steps of
+128) they have seen recently, which cuts the latency and cost of those tokens. The cache
+only matches byte-identical prefixes. Our prefix is the function definitions followed by the
+system prompt, and both used to drift:
+
+- the definitions were in `iter_modules` order, which depends on the filesystem
+- each definition was serialised in whatever key order its module wrote it in
+
+`canonical_definitions()` sorts the definitions by name and rebuilds every definition with
+sorted keys and trimmed descriptions, and `canonical_system_prompt()` normalises the system
+prompt. `main.py` builds both once at startup and never puts volatile content such as the
+time into them. The functions sent on a turn are picked by tool_selection.py, which puts the
+core set first and only ever appends to a session's selection, so each turn's prefix starts
+with the previous turn's.
+
+`fingerprint()` is a short hash of the prefix, recorded on each LLM call span, to spot
+prefixes that change when they should not.
+"""
+
+import json
+import hashlib
+
+
+def _canonical(value):
+    """
+    Rebuild a JSON value with sorted keys and trimmed strings.
+    """
+    if isinstance(value, dict):
+        return {key: _canonical(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def canonical_definitions(definitions):
+    """
+    Return the function definitions sorted by name, each with sorted keys.
+
+    Args:
+        definitions (list): The function definitions.
+
+    Returns:
+        list: The canonical definitions.
+    """
+    return [_canonical(definition) for definition in sorted(definitions, key=lambda definition: definition["name"])]
+
+
+def canonical_system_prompt(text):
+    """
+    Normalise line endings and trailing whitespace of the system prompt.
+    """
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+_fingerprints = {}
+
+
+def fingerprint(system_prompt, definitions):
+    """
+    Return a short hash of the prompt prefix, cached per set of function names.
+
+    Args:
+        system_prompt (str): The canonical system prompt.
+        definitions (list): The canonical function definitions sent with the call.
+
+    Returns:
+        str: The first 16 hex digits of the SHA-256 of the prefix.
+    """
+    key = (system_prompt, tuple(definition["name"] for definition in definitions))
+    value = _fingerprints.get(key)
+    if value is None:
+        prefix = json.dumps(definitions, separators=(",", ":")) + system_prompt
+        value = _fingerprints[key] = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+    return value
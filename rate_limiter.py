@@ -0,0 +1,309 @@
+# rate_limiter.py
+
+"""
+Client-side rate limiting and adaptive concurrency for LLM calls.
+
+When many sessions share one deployment (e.g. replay.py, or several users of one process)
+we run into the requests and tokens per minute quota. Without a limiter every session
+keeps sending, the service answers with 429s and the errors surface in `chat()`.
+`RateLimiter` sits in front of every LLM call:
+
+- Token buckets for requests and tokens per minute (LLM_REQUESTS_PER_MINUTE,
+  LLM_TOKENS_PER_MINUTE, 0 for no limit). Tokens are estimated before the call and
+  corrected from `response.usage` afterwards. The `x-ratelimit-*` response headers keep
+  the buckets in line with what the service sees, and set the limits if they are not configured.
+- The number of calls in flight adapts AIMD style: it grows by one per round of successful
+  calls up to LLM_MAX_CONCURRENCY and halves on every 429.
+- A 429 pauses every caller for the `retry-after` the service asked for (or an exponential
+  backoff with jitter) and the call is retried up to LLM_RATE_LIMIT_RETRIES times.
+- Transient failures (connection errors, timeouts, 408, 409 and 5xx responses) are retried
+  up to LLM_TRANSIENT_RETRIES times with an exponential backoff, like the OpenAI SDK's own
+  retries, which are off so that 429s are only handled here. Only the failed call backs off.
+- Waiting calls are granted round robin across sessions, so one busy session cannot starve
+  the others.
+
+The time spent waiting is recorded as the `llm.queue.delay` metric.
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict, deque
+
+import openai
+
+import telemetry
+
+
+logger = logging.getLogger()
+
+
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "5"))
+LLM_TRANSIENT_RETRIES = int(os.getenv("LLM_TRANSIENT_RETRIES", "2"))
+# Completion tokens assumed before the call, corrected from the usage afterwards
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("LLM_COMPLETION_TOKENS_ESTIMATE", "256"))
+
+MAX_BACKOFF_SECONDS = 60
+
+
+class _Bucket:
+    """
+    Token bucket refilled continuously up to a per minute limit. A limit of 0 is unlimited.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.per_minute:
+            self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def has(self, amount):
+        # A single call bigger than the whole bucket has to go once the bucket is full
+        return not self.per_minute or self.level >= min(amount, self.per_minute)
+
+    def take(self, amount):
+        if self.per_minute:
+            self.level -= amount
+
+    def wait_time(self, amount):
+        if not self.per_minute:
+            return 0.0
+        return max(0.0, (min(amount, self.per_minute) - self.level) * 60 / self.per_minute)
+
+    def sync(self, limit, remaining):
+        """
+        Align the bucket with the limit and remaining values from the response headers.
+        """
+        if limit and not self.per_minute:
+            self.per_minute = limit
+            self.level = float(limit)
+        if remaining is not None and self.per_minute:
+            self.level = min(self.level, remaining)
+
+
+class _Ticket:
+    """
+    A call waiting for, or holding, a slot.
+    """
+
+    def __init__(self, session, tokens):
+        self.session = session
+        self.tokens = tokens
+        self.granted = False
+
+
+def _header_number(headers, name):
+    """
+    Read a numeric header, None if it is missing or not a number.
+    """
+    value = headers.get(name) if headers else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def retry_after(headers):
+    """
+    Return the delay in seconds the service asked for in a 429 response, None if it did not say.
+    """
+    milliseconds = _header_number(headers, "retry-after-ms")
+    if milliseconds is not None:
+        return milliseconds / 1000
+    return _header_number(headers, "retry-after")
+
+
+def is_rate_limited(error):
+    """
+    Check whether an exception is a 429 from the service.
+    """
+    return getattr(error, "status_code", None) == 429
+
+
+def is_transient(error):
+    """
+    Check whether an exception is worth retrying: a connection error, a timeout or a 408, 409 or 5xx.
+    """
+    if isinstance(error, openai.APIConnectionError):
+        # Includes APITimeoutError
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and (status_code in (408, 409) or status_code >= 500)
+
+
+class RateLimiter:
+    """
+    Shared limiter for the LLM calls of every session in the process.
+
+    Args:
+        requests_per_minute (int): The request quota, 0 to learn it from the response headers.
+        tokens_per_minute (int): The token quota, 0 to learn it from the response headers.
+        max_concurrency (int): The most calls allowed in flight.
+        retries (int): How many times a call is retried after a 429.
+        transient_retries (int): How many times a call is retried after a transient failure.
+    """
+
+    def __init__(self, requests_per_minute=LLM_REQUESTS_PER_MINUTE, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 max_concurrency=LLM_MAX_CONCURRENCY, retries=LLM_RATE_LIMIT_RETRIES, transient_retries=LLM_TRANSIENT_RETRIES):
+        self.requests = _Bucket(requests_per_minute)
+        self.tokens = _Bucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.retries = retries
+        self.transient_retries = transient_retries
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.queues = OrderedDict()
+        self.condition = threading.Condition()
+
+    def _dispatch(self):
+        """
+        Grant slots to waiting calls, round robin across sessions. Called with the lock held.
+        """
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        granted = False
+        while self.queues and now >= self.paused_until and self.in_flight < max(1, int(self.concurrency)):
+            session, queue = next(iter(self.queues.items()))
+            ticket = queue[0]
+            if not (self.requests.has(1) and self.tokens.has(ticket.tokens)):
+                # Head of line waits so large calls are not starved by small ones
+                break
+            queue.popleft()
+            # The session goes to the back of the line
+            del self.queues[session]
+            if queue:
+                self.queues[session] = queue
+            self.requests.take(1)
+            self.tokens.take(ticket.tokens)
+            self.in_flight += 1
+            ticket.granted = True
+            granted = True
+        if granted:
+            self.condition.notify_all()
+
+    def _wait_time(self):
+        """
+        How long to sleep before the next dispatch attempt. Called with the lock held.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.queues:
+            ticket = next(iter(self.queues.values()))[0]
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(ticket.tokens))
+            if wait > 0:
+                return wait
+        # Waiting on a call in flight to finish, which notifies
+        return None
+
+    def acquire(self, session, tokens):
+        """
+        Wait for a slot.
+
+        Args:
+            session: Key of the calling session, used for fair queueing.
+            tokens (int): The estimated tokens of the call.
+
+        Returns:
+            tuple: The ticket to pass to `release()` and the seconds spent waiting.
+        """
+        ticket = _Ticket(session, tokens)
+        start = time.monotonic()
+        with self.condition:
+            self.queues.setdefault(session, deque()).append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                self.condition.wait(self._wait_time())
+                self._dispatch()
+        return ticket, time.monotonic() - start
+
+    def release(self, ticket, used_tokens=None, headers=None, rate_limited=False):
+        """
+        Give a slot back and adapt the limits from the outcome of the call.
+
+        Args:
+            ticket: The ticket from `acquire()`.
+            used_tokens (int): The tokens the call actually used, from `response.usage`.
+            headers (dict): The response headers.
+            rate_limited (bool): True if the service answered with a 429.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - ticket.tokens)
+            if headers:
+                self.requests.sync(_header_number(headers, "x-ratelimit-limit-requests"), _header_number(headers, "x-ratelimit-remaining-requests"))
+                self.tokens.sync(_header_number(headers, "x-ratelimit-limit-tokens"), _header_number(headers, "x-ratelimit-remaining-tokens"))
+            if rate_limited:
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                # Additive increase, about one more slot per round of successful calls
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / max(1.0, self.concurrency))
+            self._dispatch()
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        """
+        Hold every call back for a number of seconds, e.g. after a 429.
+        """
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def call(self, request, session, estimated_tokens):
+        """
+        Run an LLM request within the limits, retrying after 429s and transient failures.
+
+        Args:
+            request: Callable sending the request and returning the response and its headers.
+            session: Key of the calling session, used for fair queueing.
+            estimated_tokens (int): The estimated prompt and completion tokens of the call.
+
+        Returns:
+            The response returned by `request`.
+        """
+        queue_delay = 0.0
+        rate_limited_attempts = 0
+        transient_attempts = 0
+        while True:
+            ticket, waited = self.acquire(session, estimated_tokens)
+            queue_delay += waited
+            try:
+                response, headers = request()
+            except Exception as e:
+                if is_rate_limited(e):
+                    response_headers = getattr(getattr(e, "response", None), "headers", None)
+                    self.release(ticket, headers=response_headers, rate_limited=True)
+                    telemetry.record_rate_limited(rate_limited_attempts + 1)
+                    if rate_limited_attempts == self.retries:
+                        raise
+                    delay = retry_after(response_headers)
+                    if delay is None:
+                        delay = min(MAX_BACKOFF_SECONDS, 2 ** rate_limited_attempts) * random.uniform(0.5, 1.5)
+                    rate_limited_attempts += 1
+                    # Everyone slows down, the quota is shared
+                    self.pause(delay)
+                    continue
+                self.release(ticket)
+                if not is_transient(e) or transient_attempts == self.transient_retries:
+                    raise
+                # Only this call backs off, without holding a slot
+                delay = min(MAX_BACKOFF_SECONDS, 0.5 * 2 ** transient_attempts) * random.uniform(0.75, 1.25)
+                transient_attempts += 1
+                logger.warning(f"LLM call failed with {type(e).__name__}, retrying in {delay:.1f}s ({transient_attempts}/{self.transient_retries})")
+                time.sleep(delay)
+                continue
+            usage = getattr(response, "usage", None)
+            self.release(ticket, getattr(usage, "total_tokens", None), headers)
+            telemetry.record_queue_delay(queue_delay, rate_limited_attempts + transient_attempts, self.concurrency)
+            return response
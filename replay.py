@@ -0,0 +1,455 @@
+# replay.py
+
+"""
+Replay recorded conversations through the chat engine to load test the application.
+
+The replay tool reads a file of recorded conversations and drives them through `chat()`
+from `main.py`, either with a fixed number of concurrent sessions (closed loop) or with
+sessions arriving at a target rate (open loop). Each session gets its own conversation
+history and waits a modelled think time between turns, just like a real user.
+
+At the end it reports:
+- throughput (turns per second) and error rate, with a count per error type
+- p50/p95/p99 turn latency
+- a per-span breakdown of where the time went (LLM calls, search, other tools)
+
+The conversations file is JSON lines in one of two formats:
+1. One conversation per line:
+   {"user_name": "alice", "turns": [{"query": "Hi"}, {"query": "Who is Irene Adler?", "think_time": 4.2}]}
+2. Audit log records as emitted by `chat()` (one turn per line). Records are grouped into
+   conversations by `session_id` (or `user_name` for older records), and the think time is
+   taken from the gap between the `@timestamp`/`timestamp`/`created` fields when present.
+   A gap longer than `--session-gap` seconds starts a new conversation instead.
+
+It works against the real endpoints configured in `config/.env`, or against the local
+stand-ins in `stand_ins.py` with `--stand-in-llm` and `--stand-in-tools`.
+
+Example:
+    python replay.py conversations.jsonl --concurrency 8 --think-time 2 --stand-in-llm --stand-in-tools
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import logging
+import argparse
+import threading
+import contextlib
+from datetime import datetime
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+
+
+logger = logging.getLogger()
+
+# A longer pause between two turns of a user is counted as the start of a new conversation
+SESSION_GAP = 30 * 60
+
+
+############################################
+# Loading recorded conversations
+############################################
+def _record_time(record):
+    """
+    Return the time of an audit record in seconds, or None if it has no timestamp.
+    """
+    for field in ["@timestamp", "timestamp"]:
+        if field in record:
+            value = record[field]
+            if isinstance(value, (int, float)):
+                return float(value)
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    if "created" in record:
+        return float(record["created"])
+    return None
+
+
+def load_conversations(path, session_gap=SESSION_GAP):
+    """
+    Load recorded conversations from a JSON lines file.
+
+    Args:
+        path (str): The path to the conversations or audit log file, optionally gzip compressed.
+        session_gap (float): The longest gap in seconds between two audit records of a conversation.
+
+    Returns:
+        list: A list of conversations, each a dict with `user_name` and a list of `turns`.
+    """
+    conversations = []
+    # The open conversation of each session key, and every audit conversation in order of its first turn
+    audit_sessions = {}
+    audit_conversations = []
+    # The audit sink writes gzip compressed JSON lines
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "turns" in record:
+                conversations.append({
+                    "user_name": record.get("user_name", "replay"),
+                    "turns": [{"query": turn["query"], "think_time": turn.get("think_time")} for turn in record["turns"]]
+                })
+            elif "query" in record:
+                # An audit log record, group the turns by session
+                key = record.get("session_id") or record.get("user_name") or "replay"
+                session = audit_sessions.get(key)
+                record_time = _record_time(record)
+                think_time = None
+                if session is not None and record_time is not None and session["last_time"] is not None:
+                    think_time = max(0.0, record_time - session["last_time"])
+                    if think_time > session_gap:
+                        # The user came back later, that is a new conversation rather than a long think
+                        session = None
+                        think_time = None
+                if session is None:
+                    session = audit_sessions[key] = {"user_name": record.get("user_name") or "replay", "turns": [], "last_time": None}
+                    audit_conversations.append(session)
+                session["last_time"] = record_time
+                session["turns"].append({"query": record["query"], "think_time": think_time})
+            else:
+                logger.warning(f"Skipping record without 'turns' or 'query': {line[:80]}")
+
+    for session in audit_conversations:
+        conversations.append({"user_name": session["user_name"], "turns": session["turns"]})
+    return conversations
+
+
+############################################
+# Per-span breakdown
+############################################
+class BreakdownSpanProcessor(SpanProcessor):
+    """
+    Span processor that adds up the time spent in LLM calls, search and other tools per trace.
+
+    Only spans of the chat engine's own tracer count. Instrumented libraries make spans with
+    the same names, e.g. elasticsearch-py's `search` span inside the `search` tool span, and
+    counting those too would count the same time twice.
+
+    Args:
+        tool_names (list): The names of the functions, whose spans count as tools.
+        scope (str): The instrumentation scope of the chat engine's tracer.
+    """
+
+    def __init__(self, tool_names, scope):
+        self.tool_names = set(tool_names)
+        self.scope = scope
+        self.lock = threading.Lock()
+        self.by_trace = defaultdict(lambda: defaultdict(float))
+
+    def category(self, span_name):
+        if span_name == "call_llm":
+            return "llm"
+        if span_name == "search":
+            return "search"
+        if span_name in self.tool_names:
+            return "tools"
+        return None
+
+    def on_end(self, span):
+        if span.instrumentation_scope is None or span.instrumentation_scope.name != self.scope:
+            return
+        category = self.category(span.name)
+        if category is None or span.end_time is None:
+            return
+        with self.lock:
+            breakdown = self.by_trace[span.context.trace_id]
+            breakdown[category] += (span.end_time - span.start_time) / 1e9
+            if category == "llm":
+                # Token usage for the prompt cache hit ratio
+                breakdown["prompt_tokens"] += span.attributes.get("llm.usage.prompt_tokens", 0)
+                breakdown["cached_tokens"] += span.attributes.get("llm.usage.cached_tokens", 0)
+
+    def pop(self, trace_id):
+        """
+        Return and forget the breakdown for one trace.
+        """
+        with self.lock:
+            return dict(self.by_trace.pop(trace_id, {}))
+
+
+def install_breakdown_processor(tool_names, scope):
+    """
+    Add a `BreakdownSpanProcessor` to the tracer provider, creating an SDK provider if needed.
+    """
+    processor = BreakdownSpanProcessor(tool_names, scope)
+    provider = trace.get_tracer_provider()
+    if not isinstance(provider, TracerProvider):
+        # Not running under opentelemetry-instrument, we still need spans to measure
+        provider = TracerProvider()
+        trace.set_tracer_provider(provider)
+    provider.add_span_processor(processor)
+    return processor
+
+
+############################################
+# Driving the load
+############################################
+class Replay:
+    """
+    Drive recorded conversations through `chat()` and collect the turn results.
+    """
+
+    def __init__(self, engine, conversations, think_time=0.0, think_time_scale=1.0, use_recorded_think_time=True):
+        self.engine = engine
+        self.conversations = conversations
+        self.think_time = think_time
+        self.think_time_scale = think_time_scale
+        self.use_recorded_think_time = use_recorded_think_time
+        self.breakdown = install_breakdown_processor(engine.function_functions.keys(), engine.__name__)
+        self.tracer = trace.get_tracer(__name__)
+        self.results = []
+        self.lock = threading.Lock()
+        self.stop_time = None
+
+    def _think(self, turn):
+        """
+        Sleep for the think time before a turn.
+        """
+        if self.use_recorded_think_time and turn.get("think_time") is not None:
+            delay = turn["think_time"]
+        elif self.think_time > 0:
+            delay = random.expovariate(1.0 / self.think_time)
+        else:
+            delay = 0.0
+        delay *= self.think_time_scale
+        if delay > 0:
+            time.sleep(delay)
+
+    def run_session(self, session_number, conversation, arrival=None):
+        """
+        Play one conversation from start to finish with its own history.
+
+        Args:
+            session_number (int): The number of the session in the run.
+            conversation (dict): The conversation to play.
+            arrival (float): When the session was due to start (`time.perf_counter()`). The first
+                turn's latency counts from then, so time spent waiting for a worker is included.
+        """
+        queue_delay = time.perf_counter() - arrival if arrival is not None else None
+        history = self.engine.new_conversation()
+        user = f"{conversation['user_name']}-{session_number}"
+        for turn_number, turn in enumerate(conversation["turns"]):
+            if turn_number > 0:
+                self._think(turn)
+            if self.stop_time and time.monotonic() > self.stop_time:
+                return
+            error = None
+            start = arrival if turn_number == 0 and arrival is not None else time.perf_counter()
+            with self.tracer.start_as_current_span("handle_chat") as span:
+                trace_id = span.get_span_context().trace_id
+                try:
+                    reply = self.engine.chat(turn["query"], history=history, user=user, session=f"replay-{session_number}")
+                    # Like main(), the reply is added to the conversation when it is shown
+                    self.engine.print_pretty_response(reply, history)
+                except Exception as e:
+                    error = type(e).__name__
+                    span.record_exception(e)
+                    logger.debug(f"Turn failed for session {session_number}: {e}")
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.results.append({
+                    "session": session_number,
+                    "latency": latency,
+                    "queue_delay": queue_delay if turn_number == 0 else None,
+                    "error": error,
+                    "breakdown": self.breakdown.pop(trace_id),
+                })
+
+    def run_closed_loop(self, sessions, concurrency):
+        """
+        Run `sessions` conversations with a fixed number of concurrent sessions.
+        """
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for session_number in range(sessions):
+                conversation = self.conversations[session_number % len(self.conversations)]
+                executor.submit(self.run_session, session_number, conversation)
+
+    def run_open_loop(self, sessions, arrival_rate, max_sessions):
+        """
+        Start `sessions` conversations with Poisson arrivals at `arrival_rate` sessions per second.
+        """
+        with ThreadPoolExecutor(max_workers=max_sessions) as executor:
+            for session_number in range(sessions):
+                if self.stop_time and time.monotonic() > self.stop_time:
+                    break
+                conversation = self.conversations[session_number % len(self.conversations)]
+                # Sessions beyond max_sessions wait for a worker, that wait is part of their latency
+                executor.submit(self.run_session, session_number, conversation, time.perf_counter())
+                time.sleep(random.expovariate(arrival_rate))
+
+
+############################################
+# Reporting
+############################################
+def build_report(results, elapsed):
+    """
+    Summarise the turn results into throughput, latency, breakdown and error figures.
+
+    Args:
+        results (list): The turn results collected by `Replay`.
+        elapsed (float): The wall clock duration of the run in seconds.
+
+    Returns:
+        dict: The report.
+    """
+    # Imported here, after main.py has loaded the configuration telemetry reads at import time
+    from telemetry import percentile
+    latencies = [result["latency"] for result in results if result["error"] is None]
+    # Only the first turn of an open loop session can wait for a worker
+    queue_delays = [result["queue_delay"] for result in results if result.get("queue_delay") is not None]
+    errors = Counter(result["error"] for result in results if result["error"] is not None)
+    breakdown = {}
+    for category in ["llm", "search", "tools"]:
+        values = [result["breakdown"].get(category, 0.0) for result in results if result["error"] is None]
+        total = sum(values)
+        breakdown[category] = {
+            "mean_s": total / len(values) if values else None,
+            "p50_s": percentile(values, 0.50),
+            "p95_s": percentile(values, 0.95),
+            "share_of_latency": total / sum(latencies) if latencies and sum(latencies) > 0 else None,
+        }
+    prompt_tokens = int(sum(result["breakdown"].get("prompt_tokens", 0) for result in results))
+    cached_tokens = int(sum(result["breakdown"].get("cached_tokens", 0) for result in results))
+    return {
+        "turns": len(results),
+        "sessions": len({result["session"] for result in results}),
+        "elapsed_s": elapsed,
+        "throughput_turns_per_s": len(results) / elapsed if elapsed > 0 else None,
+        "error_rate": sum(errors.values()) / len(results) if results else None,
+        "errors": dict(errors),
+        "latency_s": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if latencies else None,
+        },
+        "queue_delay_s": {
+            "sessions": len(queue_delays),
+            "p50": percentile(queue_delays, 0.50),
+            "p95": percentile(queue_delays, 0.95),
+            "max": max(queue_delays) if queue_delays else None,
+        },
+        "breakdown": breakdown,
+        "prompt_cache": {
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "hit_ratio": cached_tokens / prompt_tokens if prompt_tokens else None,
+        },
+    }
+
+
+def _format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.0f} ms"
+
+
+def print_report(report):
+    """
+    Print the report in a readable format.
+    """
+    print("-" * 50)
+    print(f"Sessions: {report['sessions']}  Turns: {report['turns']}  Elapsed: {report['elapsed_s']:.1f} s")
+    print(f"Throughput: {report['throughput_turns_per_s'] or 0:.2f} turns/s")
+    print(f"Error rate: {(report['error_rate'] or 0) * 100:.1f}%  {report['errors'] or ''}")
+    latency = report["latency_s"]
+    print(f"Turn latency: p50 {_format_seconds(latency['p50'])}  p95 {_format_seconds(latency['p95'])}  "
+          f"p99 {_format_seconds(latency['p99'])}  max {_format_seconds(latency['max'])}")
+    queue_delay = report["queue_delay_s"]
+    if queue_delay["sessions"]:
+        print(f"Wait for a worker (open loop): p50 {_format_seconds(queue_delay['p50'])}  "
+              f"p95 {_format_seconds(queue_delay['p95'])}  max {_format_seconds(queue_delay['max'])} (included in the turn latency)")
+    print("Breakdown per turn:")
+    for category, figures in report["breakdown"].items():
+        share = figures["share_of_latency"]
+        share_text = "-" if share is None else f"{share * 100:.0f}%"
+        print(f"  {category:<8} mean {_format_seconds(figures['mean_s']):>9}  p50 {_format_seconds(figures['p50_s']):>9}  "
+              f"p95 {_format_seconds(figures['p95_s']):>9}  share {share_text:>4}")
+    cache = report["prompt_cache"]
+    hit_ratio = "-" if cache["hit_ratio"] is None else f"{cache['hit_ratio'] * 100:.0f}%"
+    print(f"Prompt cache: {cache['cached_tokens']} of {cache['prompt_tokens']} prompt tokens cached ({hit_ratio})")
+    print("-" * 50)
+
+
+def main():
+    """
+    Parse the arguments, load the conversations, run the replay and print the report.
+    """
+    parser = argparse.ArgumentParser(description="Replay recorded conversations through the chat engine.")
+    parser.add_argument("conversations", help="JSON lines file of conversations or audit log records")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of concurrent sessions (closed loop)")
+    parser.add_argument("--arrival-rate", type=float, default=None, help="New sessions per second (open loop), overrides --concurrency")
+    parser.add_argument("--max-sessions", type=int, default=256, help="Maximum concurrent sessions in open loop mode")
+    parser.add_argument("--sessions", type=int, default=None, help="Number of sessions to run, cycling through the conversations (default: one per conversation)")
+    parser.add_argument("--duration", type=float, default=None, help="Stop starting new turns after this many seconds")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Mean think time in seconds between turns when none is recorded")
+    parser.add_argument("--think-time-scale", type=float, default=1.0, help="Multiply every think time by this factor")
+    parser.add_argument("--ignore-recorded-think-time", action="store_true", help="Use --think-time even when the recording has think times")
+    parser.add_argument("--session-gap", type=float, default=SESSION_GAP, help="Audit log records further apart than this many seconds start a new conversation")
+    parser.add_argument("--stand-in-llm", action="store_true", help="Use the local LLM stand-in instead of the configured endpoint")
+    parser.add_argument("--stand-in-tools", action="store_true", help="Use local stand-ins for the functions, including search")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for arrivals and think times")
+    parser.add_argument("--output", type=str, default=None, help="Write the report as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the chat output while replaying")
+    parser.add_argument("--log-level", type=str, default="WARNING", help="Set the logging level")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    # main.py reads these when it is imported
+    if args.stand_in_llm:
+        os.environ["LLM_STAND_IN"] = "true"
+    if args.stand_in_tools:
+        os.environ["TOOL_STAND_IN"] = "true"
+    import main as engine
+    logging.getLogger().setLevel(args.log_level)
+
+    conversations = load_conversations(args.conversations, args.session_gap)
+    if not conversations:
+        print("No conversations found")
+        sys.exit(1)
+    sessions = args.sessions or len(conversations)
+
+    replay = Replay(
+        engine,
+        conversations,
+        think_time=args.think_time,
+        think_time_scale=args.think_time_scale,
+        use_recorded_think_time=not args.ignore_recorded_think_time,
+    )
+    start = time.monotonic()
+    if args.duration:
+        replay.stop_time = start + args.duration
+
+    if args.arrival_rate:
+        print(f"Replaying {sessions} sessions at {args.arrival_rate} sessions/s")
+    else:
+        print(f"Replaying {sessions} sessions with concurrency {args.concurrency}")
+    with open(os.devnull, "w") as devnull:
+        # The chat prints every reply, hide it unless asked for
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+        with output:
+            if args.arrival_rate:
+                replay.run_open_loop(sessions, args.arrival_rate, args.max_sessions)
+            else:
+                replay.run_closed_loop(sessions, args.concurrency)
+    elapsed = time.monotonic() - start
+
+    report = build_report(replay.results, elapsed)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# rerank.py
+
+"""
+Local second-stage reranking of search candidates with maximal marginal relevance (MMR).
+
+`search()` used to trust the first hit from Elasticsearch. With semantic_text the best hits
+are often two near-duplicate passages of the same book, while a better passage sits a few
+places down. With SEARCH_RERANK=true `search()` asks for a wider candidate set instead
+(RERANK_CANDIDATES passages, fetching only the passage text with `_source` filtering) and
+picks the passages to send here:
+
+1. Relevance: BM25 of the query terms over the candidate passages (IDF from the candidate
+   set), blended with the Elasticsearch score. Both are min-max normalised and
+   RERANK_ES_WEIGHT sets the share of the Elasticsearch score.
+2. Diversity: MMR picks RERANK_TOP_K passages one at a time, trading relevance against the
+   cosine similarity (of term frequency vectors) to the passages already picked, with
+   RERANK_LAMBDA as the weight of relevance.
+
+Everything is vectorised with NumPy over a candidates x terms matrix. The stage has a hard
+budget of RERANK_BUDGET_MS of CPU time, checked after each costly step (the term matrix,
+the scores, the candidate similarities): if any of them runs over it, the candidates are
+returned in Elasticsearch order. Any MMR step over the budget stops the selection early.
+
+Run `python rerank.py` to benchmark the added latency against the tokens of near-duplicate
+passages that are no longer sent to the LLM.
+"""
+
+import os
+import time
+import argparse
+from collections import Counter
+
+import numpy as np
+
+import telemetry
+from local_search import tokenize, K1, B, BENCHMARK_QUERIES
+
+
+def load_settings():
+    """
+    Read the RERANK_* settings from the environment.
+    """
+    global RERANK_CANDIDATES, RERANK_TOP_K, RERANK_LAMBDA, RERANK_ES_WEIGHT, RERANK_BUDGET_MS
+    RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+    RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "2"))
+    RERANK_LAMBDA = float(os.getenv("RERANK_LAMBDA", "0.7"))
+    RERANK_ES_WEIGHT = float(os.getenv("RERANK_ES_WEIGHT", "0.3"))
+    RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "20"))
+
+
+load_settings()
+
+# Passages more similar than this to a better one are counted as near-duplicates by the benchmark
+DUPLICATE_SIMILARITY = 0.8
+
+
+def widen_query(template, context_fields, candidates=None):
+    """
+    Change a search body to return a wider candidate set with only the text needed to rerank.
+
+    Args:
+        template (dict): The search body built from the query template.
+        context_fields (list): The document fields used as the text when there are no inner hits.
+        candidates (int): Passages to fetch, defaults to RERANK_CANDIDATES.
+
+    Returns:
+        dict: The search body, changed in place.
+    """
+    candidates = candidates or RERANK_CANDIDATES
+
+    def widen_inner_hits(value):
+        found = False
+        if isinstance(value, dict):
+            if isinstance(value.get("inner_hits"), dict):
+                value["inner_hits"]["size"] = candidates
+                found = True
+            for item in value.values():
+                found = widen_inner_hits(item) or found
+        elif isinstance(value, list):
+            for item in value:
+                found = widen_inner_hits(item) or found
+        return found
+
+    if widen_inner_hits(template):
+        # The passages come from the inner hits, the documents themselves are not needed
+        template["_source"] = False
+        template.setdefault("size", 10)
+    else:
+        template["_source"] = context_fields
+        template["size"] = candidates
+    return template
+
+
+def candidates_from_hits(search_results, context_fields):
+    """
+    Flatten a search response into candidate passages.
+
+    Returns:
+        list: Candidates with the document `id`, the Elasticsearch `score` and the passage `text`.
+    """
+    candidates = []
+    for hit in search_results.get("hits", {}).get("hits", []):
+        if hit.get("inner_hits"):
+            for group in hit["inner_hits"].values():
+                for inner_hit in group.get("hits", {}).get("hits", []):
+                    text = inner_hit.get("_source", {}).get("text")
+                    if text:
+                        candidates.append({"id": hit.get("_id"), "score": inner_hit.get("_score") or 0.0, "text": text})
+        else:
+            source = hit.get("_source", {})
+            text = "\n".join(str(source[field]) for field in context_fields if source.get(field))
+            if text:
+                candidates.append({"id": hit.get("_id"), "score": hit.get("_score") or 0.0, "text": text})
+    return candidates
+
+
+def _normalise(values):
+    spread = values.max() - values.min()
+    return (values - values.min()) / spread if spread > 0 else np.ones_like(values)
+
+
+def _term_matrix(query_text, candidates):
+    """
+    Build the candidates x terms frequency matrix and the ids of the query terms.
+    """
+    vocabulary = {}
+    rows = []
+    columns = []
+    counts = []
+    for row, candidate in enumerate(candidates):
+        for term, count in Counter(tokenize(candidate["text"])).items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(count)
+    matrix = np.zeros((len(candidates), max(1, len(vocabulary))), dtype=np.float32)
+    matrix[rows, columns] = counts
+    query_terms = sorted({vocabulary[term] for term in tokenize(query_text) if term in vocabulary})
+    return matrix, query_terms
+
+
+def relevance(query_text, candidates, matrix=None, query_terms=None):
+    """
+    Score candidates by BM25 over their text blended with the Elasticsearch score.
+    """
+    if matrix is None:
+        matrix, query_terms = _term_matrix(query_text, candidates)
+    es_scores = np.array([candidate["score"] for candidate in candidates], dtype=np.float32)
+    if query_terms:
+        tf = matrix[:, query_terms]
+        lengths = matrix.sum(axis=1)
+        document_frequency = (tf > 0).sum(axis=0)
+        idf = np.log(1 + (len(candidates) - document_frequency + 0.5) / (document_frequency + 0.5))
+        norm = K1 * (1 - B + B * lengths / max(lengths.mean(), 1.0))
+        lexical = (idf * tf * (K1 + 1) / (tf + norm[:, None])).sum(axis=1)
+    else:
+        lexical = np.zeros(len(candidates), dtype=np.float32)
+    return (1 - RERANK_ES_WEIGHT) * _normalise(lexical) + RERANK_ES_WEIGHT * _normalise(es_scores)
+
+
+def similarities(matrix):
+    """
+    Cosine similarity between every pair of candidates.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    unit = matrix / np.maximum(norms, 1e-9)
+    return unit @ unit.T
+
+
+def rerank(query_text, candidates, top_k=None, budget_ms=None):
+    """
+    Pick the most relevant, least redundant passages.
+
+    Args:
+        query_text (str): The search query.
+        candidates (list): Candidates from `candidates_from_hits()`, in Elasticsearch order.
+        top_k (int): Passages to pick, defaults to RERANK_TOP_K.
+        budget_ms (float): The CPU time budget, defaults to RERANK_BUDGET_MS.
+
+    Returns:
+        list: The picked candidates, best first.
+    """
+    top_k = top_k or RERANK_TOP_K
+    budget = (budget_ms if budget_ms is not None else RERANK_BUDGET_MS) / 1000
+    start = time.thread_time()
+    if len(candidates) <= 1:
+        return candidates[:top_k]
+
+    def out_of_budget():
+        return time.thread_time() - start > budget
+
+    # The costly steps grow with the candidates (and their square for the similarities), so
+    # check the budget after each, keeping the Elasticsearch order if we run out before picking
+    matrix, query_terms = _term_matrix(query_text, candidates)
+    if not out_of_budget():
+        scores = relevance(query_text, candidates, matrix, query_terms)
+        if not out_of_budget():
+            similarity = similarities(matrix)
+    if out_of_budget():
+        telemetry.record_rerank(len(candidates), time.thread_time() - start, budget_exceeded=True)
+        return candidates[:top_k]
+
+    selected = [int(np.argmax(scores))]
+    # The highest similarity of each candidate to anything picked so far
+    redundancy = similarity[selected[0]].copy()
+    budget_exceeded = False
+    while len(selected) < min(top_k, len(candidates)):
+        if time.thread_time() - start > budget:
+            budget_exceeded = True
+            break
+        mmr = RERANK_LAMBDA * scores - (1 - RERANK_LAMBDA) * redundancy
+        mmr[selected] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    telemetry.record_rerank(len(candidates), time.thread_time() - start, budget_exceeded)
+    return [candidates[index] for index in selected]
+
+
+def redundant_tokens(candidates):
+    """
+    Estimate the tokens of passages that are near-duplicates of an earlier passage in the list.
+    """
+    if len(candidates) < 2:
+        return 0
+    matrix, _ = _term_matrix("", candidates)
+    similarity = similarities(matrix)
+    tokens = 0
+    for index in range(1, len(candidates)):
+        if similarity[index, :index].max() >= DUPLICATE_SIMILARITY:
+            tokens += len(candidates[index]["text"]) // 4
+    return tokens
+
+
+def benchmark(queries, candidate_source, top_k):
+    """
+    Compare the first `top_k` candidates in search order with the reranked ones.
+    """
+    added = []
+    saved = 0
+    sent = 0
+    for query in queries:
+        candidates = candidate_source(query)
+        baseline = candidates[:top_k]
+        start = time.perf_counter()
+        picked = rerank(query, candidates, top_k=top_k, budget_ms=float("inf"))
+        added.append(time.perf_counter() - start)
+        baseline_redundant = redundant_tokens(baseline)
+        saved += baseline_redundant - redundant_tokens(picked)
+        sent += sum(len(candidate["text"]) // 4 for candidate in baseline)
+        print(f"{query[:40]:<40} {len(candidates):>3} candidates  rerank {added[-1] * 1000:6.2f} ms  "
+              f"near-duplicate tokens {baseline_redundant:>5} -> {redundant_tokens(picked):>5}")
+    print("-" * 50)
+    print(f"Added latency: p50 {telemetry.percentile(added, 0.50) * 1000:.2f} ms  max {max(added) * 1000:.2f} ms")
+    print(f"Near-duplicate tokens no longer sent: {saved} of {sent} ({saved / max(sent, 1) * 100:.0f}%)")
+
+
+def main():
+    """
+    Benchmark the reranker on candidates from the local index or Elasticsearch.
+    """
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="./config/.env", override=True)
+    # The settings were read on import, before the configuration was loaded
+    load_settings()
+
+    parser = argparse.ArgumentParser(description="Benchmark the reranker's added latency against the tokens it saves.")
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument("--local", action="store_true", help="Take the candidates from the local BM25 index instead of Elasticsearch")
+    parser.add_argument("--top-k", type=int, default=RERANK_TOP_K)
+    args = parser.parse_args()
+
+    queries = BENCHMARK_QUERIES
+    if args.queries:
+        with open(args.queries, "r") as file:
+            queries = [line.strip() for line in file if line.strip()]
+
+    if args.local:
+        import local_search
+        index = local_search.LocalIndex(os.getenv("LOCAL_SEARCH_INDEX", local_search.LOCAL_SEARCH_INDEX))
+        candidate_source = lambda query: index.search(query, k=RERANK_CANDIDATES)
+    else:
+        from llm_functions import search as search_function
+        context_fields = os.getenv("CONTEXT_FIELDS", "content").split(",")
+        index = os.getenv("ELASTICSEARCH_INDEX")
+
+        def candidate_source(query):
+            body = widen_query(search_function.build_query(query), context_fields)
+            return candidates_from_hits(search_function.get_client().search(index=index, body=body), context_fields)
+    benchmark(queries, candidate_source, args.top_k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# result_encoding.py
+
+"""
+Compact encoding of function results before they are added to the conversation.
+
+Every function result stays in the conversation and is sent again with every later LLM
+call of the session, so its size is paid for many times. `encode_tool_result()` turns a
+result into the smallest valid JSON that still carries the same information:
+
+- minified JSON (no padding, no Python repr quirks such as `None` or single quotes)
+- lists of records with the same keys become a table: `{"columns": [...], "rows": [[...], ...]}`
+  so the keys are not repeated on every row
+- floats are rounded to RESULT_FLOAT_PRECISION decimal places
+- results over RESULT_MAX_TOKENS tokens are cut down (rows dropped, long text shortened)
+  and marked as truncated; 0 disables the cap
+
+Token counts are estimated at 4 characters per token, which is close enough to compare sizes.
+"""
+
+import os
+import json
+import math
+
+
+RESULT_FLOAT_PRECISION = int(os.getenv("RESULT_FLOAT_PRECISION", "2"))
+RESULT_MAX_TOKENS = int(os.getenv("RESULT_MAX_TOKENS", "1500"))
+
+TRUNCATION_MARKER = "...[truncated]"
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens in a text (4 characters per token).
+    """
+    return math.ceil(len(text) / 4)
+
+
+def _compact(value, precision):
+    """
+    Convert a result into plain JSON types, rounding floats and tabulating record lists.
+    """
+    # numpy and pandas scalars
+    if hasattr(value, "item") and not isinstance(value, (list, dict, str)):
+        try:
+            value = value.item()
+        except (TypeError, ValueError):
+            pass
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return None
+        rounded = round(value, precision)
+        return int(rounded) if rounded.is_integer() else rounded
+    if isinstance(value, dict):
+        return {str(key): _compact(item, precision) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [_compact(item, precision) for item in value]
+        if len(items) > 1 and all(isinstance(item, dict) for item in items):
+            columns = list(items[0].keys())
+            if all(list(item.keys()) == columns for item in items):
+                return {"columns": columns, "rows": [[item[column] for column in columns] for item in items]}
+        return items
+    if value is None or isinstance(value, (str, int, bool)):
+        return value
+    return str(value)
+
+
+def _dumps(result):
+    return json.dumps({"result": result}, separators=(",", ":"), ensure_ascii=False)
+
+
+def _shorten_strings(value, max_length):
+    """
+    Cut every string longer than `max_length` characters.
+    """
+    if isinstance(value, str) and len(value) > max_length:
+        return value[:max_length] + TRUNCATION_MARKER
+    if isinstance(value, dict):
+        return {key: _shorten_strings(item, max_length) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten_strings(item, max_length) for item in value]
+    return value
+
+
+def _longest_string(value):
+    """
+    Return the length of the longest string in a compacted result.
+    """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return max((_longest_string(item) for item in value.values()), default=0)
+    if isinstance(value, list):
+        return max((_longest_string(item) for item in value), default=0)
+    return 0
+
+
+def _truncate(result, max_tokens):
+    """
+    Cut a compacted result down to `max_tokens`, returning the encoded JSON.
+    """
+    max_chars = max_tokens * 4
+    # Tables lose rows from the end
+    if isinstance(result, dict) and "rows" in result and "columns" in result:
+        rows = result["rows"]
+        # Start from the size of an empty table and add rows (plus a comma) while they fit
+        length = len(_dumps({"columns": result["columns"], "rows": [], "omitted_rows": len(rows)}))
+        keep = 0
+        for row in rows:
+            length += len(json.dumps(row, separators=(",", ":"), ensure_ascii=False)) + 1
+            if length > max_chars:
+                break
+            keep += 1
+        if keep > 0:
+            return _dumps({"columns": result["columns"], "rows": rows[:keep], "omitted_rows": len(rows) - keep})
+        result = {"columns": result["columns"], "rows": [], "omitted_rows": len(rows)}
+
+    # Long text is shortened to the longest string length that still fits, found by bisection
+    # as JSON escaping and the wrapper make the overhead depend on the content
+    low, high = 0, min(max_chars, _longest_string(result))
+    best = None
+    while low <= high:
+        max_length = (low + high) // 2
+        encoded = _dumps(_shorten_strings(result, max_length))
+        if len(encoded) <= max_chars:
+            best = encoded
+            low = max_length + 1
+        else:
+            high = max_length - 1
+    if best is not None:
+        return best
+
+    # Still too big (e.g. a huge list of small values), keep the start of the JSON as text
+    text = json.dumps(result, separators=(",", ":"), ensure_ascii=False)
+    return _dumps(text[:max(0, max_chars - 40)] + TRUNCATION_MARKER)
+
+
+def encode_tool_result(result, precision=None, max_tokens=None, compare=False):
+    """
+    Encode a function result as compact JSON for the conversation.
+
+    Args:
+        result: The value returned by the function.
+        precision (int): Decimal places for floats, defaults to RESULT_FLOAT_PRECISION.
+        max_tokens (int): The token cap, defaults to RESULT_MAX_TOKENS. 0 disables the cap.
+        compare (bool): Also report `bytes_saved` and `tokens_saved` against the old
+            `{"result": <repr>}` encoding. That needs `str(result)`, which can be as costly as
+            the encoding itself, so only ask for it when the statistics are recorded.
+
+    Returns:
+        tuple: The encoded JSON string and a dict of size statistics.
+    """
+    if precision is None:
+        precision = RESULT_FLOAT_PRECISION
+    if max_tokens is None:
+        max_tokens = RESULT_MAX_TOKENS
+
+    compacted = _compact(result, precision)
+    encoded = _dumps(compacted)
+    truncated = False
+    if max_tokens and estimate_tokens(encoded) > max_tokens:
+        encoded = _truncate(compacted, max_tokens)
+        truncated = True
+
+    stats = {
+        "bytes": len(encoded.encode("utf-8")),
+        "tokens": estimate_tokens(encoded),
+        "truncated": truncated,
+    }
+    if compare:
+        original = f'{{"result": {str(result)} }}'
+        stats["bytes_saved"] = len(original.encode("utf-8")) - stats["bytes"]
+        stats["tokens_saved"] = estimate_tokens(original) - stats["tokens"]
+    return encoded, stats
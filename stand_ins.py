@@ -0,0 +1,221 @@
+# stand_ins.py
+
+"""
+Local stand-ins for the external services the chat application depends on.
+
+The stand-ins let the application, and in particular the replay tool in `replay.py`,
+run without an LLM endpoint, an Elasticsearch cluster or internet access. They keep
+the same shapes as the real services so `chat()` cannot tell the difference:
+
+- `StandInClient` mimics `client.chat.completions.create(...)` from the OpenAI SDK.
+  It decides whether to call a function, sleeps for a configurable latency and
+  returns a response with `choices` and `usage` like the real thing.
+- `stand_in_tool(name)` returns a function that sleeps for a configurable latency
+  and returns a canned result of the same type as the real tool.
+
+The LLM stand-in also mimics the provider's prompt cache: prompt prefixes it has seen
+before (from 1024 tokens, in steps of 128) are reported as `cached_tokens`.
+
+Latencies are configured with environment variables (in seconds):
+- STAND_IN_LLM_LATENCY: mean latency of a completion (default 0.8)
+- STAND_IN_TOOL_LATENCY: mean latency of a tool call (default 0.05)
+- STAND_IN_SEARCH_LATENCY: mean latency of a search (default 0.15)
+- STAND_IN_TOOL_RATIO: fraction of user turns that trigger a search (default 0.5)
+"""
+
+import os
+import json
+import random
+import time
+import zlib
+import hashlib
+import threading
+from types import SimpleNamespace
+
+
+STAND_IN_LLM_LATENCY = float(os.getenv("STAND_IN_LLM_LATENCY", "0.8"))
+STAND_IN_TOOL_LATENCY = float(os.getenv("STAND_IN_TOOL_LATENCY", "0.05"))
+STAND_IN_SEARCH_LATENCY = float(os.getenv("STAND_IN_SEARCH_LATENCY", "0.15"))
+STAND_IN_TOOL_RATIO = float(os.getenv("STAND_IN_TOOL_RATIO", "0.5"))
+
+# Words in the user's input that make the stand-in call a specific function
+TOOL_KEYWORDS = {
+    "current_time": ["time", "date", "clock"],
+    "get_weather": ["weather", "rain", "raining", "sunny", "temperature"],
+    "get_aprox_location": ["where am i", "location"],
+    "get_hostname": ["hostname"],
+    "get_public_ip": ["ip address", "public ip"],
+    "get_stock_info": ["stock", "share price", "ticker"],
+    "emojistr": ["emoji"],
+}
+
+PASSAGE = (
+    "To Sherlock Holmes she is always the woman. I have seldom heard him mention her "
+    "under any other name. In his eyes she eclipses and predominates the whole of her sex. "
+)
+
+
+def _sleep(mean):
+    """
+    Sleep for a random time around `mean` seconds (log-normal, so there is a tail).
+    """
+    if mean > 0:
+        time.sleep(mean * random.lognormvariate(0, 0.25))
+
+
+def _estimate_tokens(text):
+    """
+    Rough token estimate (4 characters per token) used to fill in `usage`.
+    """
+    return max(1, len(text) // 4)
+
+
+# Like the provider's prompt cache: minimum cached prefix and granularity, in tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+PROMPT_CACHE_MAX_ENTRIES = 100000
+
+_prompt_cache = set()
+_prompt_cache_lock = threading.Lock()
+
+
+def _cached_tokens(messages, functions):
+    """
+    Return the tokens of the longest prefix (at a message boundary) seen in an earlier call.
+    """
+    # The functions come first, as the provider renders them before the messages
+    digest = hashlib.sha256(json.dumps(functions or []).encode("utf-8"))
+    length = len(json.dumps(functions or []))
+    cached = 0
+    with _prompt_cache_lock:
+        if len(_prompt_cache) > PROMPT_CACHE_MAX_ENTRIES:
+            _prompt_cache.clear()
+        for message in messages:
+            text = json.dumps(message)
+            digest.update(text.encode("utf-8"))
+            length += len(text)
+            key = digest.hexdigest()
+            if key in _prompt_cache:
+                cached = length // 4
+            _prompt_cache.add(key)
+    if cached < PROMPT_CACHE_MIN_TOKENS:
+        return 0
+    return cached - cached % PROMPT_CACHE_STEP_TOKENS
+
+
+def _placeholder_arguments(definition, user_input):
+    """
+    Build arguments for a function call from its JSON schema definition.
+    """
+    arguments = {}
+    properties = definition.get("parameters", {}).get("properties", {})
+    for name, schema in properties.items():
+        if schema.get("type") in ["number", "integer"]:
+            arguments[name] = 0
+        else:
+            arguments[name] = user_input
+    return arguments
+
+
+class StandInCompletions:
+    """
+    Stand-in for `client.chat.completions`.
+    """
+
+    def create(self, model, messages, stream=False, functions=None, **kwargs):
+        """
+        Return a completion shaped like the OpenAI SDK response.
+
+        If the last message is from the user the stand-in may ask for a function call,
+        otherwise it replies with a short text answer. With `stream=True` it returns the
+        response as chunks, the first one after part of the latency.
+        """
+        prompt_text = json.dumps(messages) + json.dumps(functions or [])
+        last_message = messages[-1]
+
+        function_call = None
+        if last_message["role"] == "user" and functions:
+            function_call = self._choose_function(last_message["content"] or "", functions)
+
+        if function_call:
+            finish_reason = "function_call"
+            content = None
+            completion_text = function_call.arguments
+        else:
+            finish_reason = "stop"
+            content = f"(stand-in reply to a {len(messages)} message conversation)"
+            completion_text = content
+
+        usage = SimpleNamespace(
+            prompt_tokens=_estimate_tokens(prompt_text),
+            completion_tokens=_estimate_tokens(completion_text),
+            total_tokens=_estimate_tokens(prompt_text) + _estimate_tokens(completion_text),
+            prompt_tokens_details=SimpleNamespace(cached_tokens=min(_cached_tokens(messages, functions), _estimate_tokens(prompt_text))),
+        )
+        if stream:
+            return self._stream(model, content, function_call, finish_reason, usage)
+
+        _sleep(STAND_IN_LLM_LATENCY)
+        message = SimpleNamespace(role="assistant", content=content, function_call=function_call)
+        choice = SimpleNamespace(index=0, finish_reason=finish_reason, message=message)
+        return SimpleNamespace(id="stand-in", model=model, choices=[choice], usage=usage)
+
+    def _stream(self, model, content, function_call, finish_reason, usage):
+        """
+        Yield the response as streaming chunks: the delta, the finish reason, then the usage.
+        """
+        _sleep(STAND_IN_LLM_LATENCY * 0.4)
+        delta = SimpleNamespace(content=content, function_call=function_call)
+        yield SimpleNamespace(model=model, usage=None, choices=[SimpleNamespace(index=0, delta=delta, finish_reason=None)])
+        _sleep(STAND_IN_LLM_LATENCY * 0.6)
+        delta = SimpleNamespace(content=None, function_call=None)
+        yield SimpleNamespace(model=model, usage=None, choices=[SimpleNamespace(index=0, delta=delta, finish_reason=finish_reason)])
+        yield SimpleNamespace(model=model, usage=usage, choices=[])
+
+    def _choose_function(self, user_input, functions):
+        """
+        Pick a function to call for the user's input, or None to answer directly.
+        """
+        available = {definition["name"]: definition for definition in functions}
+        lowered = user_input.lower()
+        for name, keywords in TOOL_KEYWORDS.items():
+            if name in available and any(keyword in lowered for keyword in keywords):
+                arguments = _placeholder_arguments(available[name], user_input)
+                return SimpleNamespace(name=name, arguments=json.dumps(arguments))
+
+        # Deterministic per input so replays are repeatable
+        if "search" in available and zlib.crc32(lowered.encode("utf-8")) % 1000 < STAND_IN_TOOL_RATIO * 1000:
+            arguments = {"query_text": user_input}
+            return SimpleNamespace(name="search", arguments=json.dumps(arguments))
+        return None
+
+
+class StandInClient:
+    """
+    Stand-in for the OpenAI / Azure OpenAI client.
+    """
+
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=StandInCompletions())
+
+
+def stand_in_tool(name):
+    """
+    Return a stand-in implementation for the tool called `name`.
+
+    Args:
+        name (str): The name of the tool to replace.
+
+    Returns:
+        function: A function that accepts the tool's arguments and returns a canned result.
+    """
+    def search(**kwargs):
+        _sleep(STAND_IN_SEARCH_LATENCY)
+        document_id = f"stand-in-{zlib.crc32(json.dumps(kwargs).encode('utf-8')) % 100}"
+        return {"type": "search-result", "id": document_id, "text": PASSAGE * 8}
+
+    def tool(**kwargs):
+        _sleep(STAND_IN_TOOL_LATENCY)
+        return f"stand-in result for {name}"
+
+    return search if name == "search" else tool
@@ -31,5 +31,10 @@ if [ -z "${OTEL_EXPORTER_OTLP_HEADERS+x}" ]; then
     exit 1
 fi
 
+# With tail sampling the app exports the traces itself, through the sampler (see telemetry.py)
+if [ "${TELEMETRY_TAIL_SAMPLING}" = "true" ]; then
+    export OTEL_TRACES_EXPORTER=none
+fi
+
 # Run the application with OpenTelemetry instrumentation
 opentelemetry-instrument python main.py
@@ -0,0 +1,527 @@
+# telemetry.py
+
+"""
+OpenTelemetry metrics and telemetry cost controls for the chat application.
+
+Traces tell us about a single slow turn, metrics tell us where time and tokens go across
+all of them. This module creates the instruments once using the OpenTelemetry Meter API
+and exposes small helpers that `main.py` and the functions in `llm_functions` call.
+
+When the application is started with `opentelemetry-instrument` (see `start-app-with-otel.sh`)
+the metrics are exported with the rest of the telemetry, otherwise the Meter API is a no-op.
+
+The metrics are:
+- llm.request.duration: latency of each LLM call (s)
+- llm.time_to_first_token: time until the first streamed token (s, only when LLM_STREAM=true)
+- llm.tokens.prompt / llm.tokens.completion / llm.tokens.cached: token usage from `response.usage`
+- llm.prompt_cache.hit_ratio: share of the prompt tokens of each call served from the provider's
+  prompt cache (see prompt_prefix.py)
+- llm.errors: failed LLM calls
+- llm.route.decisions / llm.route.escalations: routing decisions between the fast and strong
+  deployments (see model_router.py), by route and reason
+- llm.queue.delay: time an LLM call waited for the client-side rate limiter (s, see rate_limiter.py)
+- llm.rate_limited: 429 responses from the LLM service
+- tool.duration / tool.errors: duration and failures of each function call, by `tool.name`
+- elasticsearch.search.took: time Elasticsearch reports it spent on the search (s)
+- elasticsearch.search.round_trip: time the client waited for the search (s)
+- elasticsearch.search.overhead: round trip minus took, i.e. network, queueing and (de)serialisation (s)
+- search.rerank.duration: CPU time of the local rerank stage (s, see rerank.py)
+- audit.records.dropped: audit records dropped because the audit queue was full
+
+For Elasticsearch, `elasticsearch_headers()` stamps requests with an X-Opaque-Id and W3C trace
+context so they can be found in the slow log and task list, and `record_search_profile()`
+attaches the timing breakdown of a profiled search to the span.
+
+It also keeps the cost of telemetry in check:
+- `limit_text()` truncates (or hashes) large text before it goes into span events and logs.
+  TELEMETRY_MAX_TEXT_LENGTH sets the limit and TELEMETRY_HASH_TEXT=true replaces large text
+  with its length and hash only.
+- `TailSamplingSpanProcessor` exports a share (TELEMETRY_SAMPLE_RATIO) of the traces, picked
+  up front by trace id, and holds the spans of the other traces until they finish. Of those it
+  only exports the slow (TELEMETRY_SLOW_TRACE_SECONDS), errored or tool failure traces.
+  It is enabled with TELEMETRY_TAIL_SAMPLING=true, and then replaces the trace exporter of
+  `opentelemetry-instrument` (start-app-with-otel.sh sets OTEL_TRACES_EXPORTER=none).
+"""
+
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+from urllib.parse import quote
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from opentelemetry import metrics, trace, propagate
+from opentelemetry.trace import Status, StatusCode
+from opentelemetry.sdk.trace import TracerProvider, SpanProcessor
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+
+logger = logging.getLogger()
+
+TELEMETRY_MAX_TEXT_LENGTH = int(os.getenv("TELEMETRY_MAX_TEXT_LENGTH", "1024"))
+TELEMETRY_HASH_TEXT = os.getenv("TELEMETRY_HASH_TEXT", "false").lower() == "true"
+TELEMETRY_TAIL_SAMPLING = os.getenv("TELEMETRY_TAIL_SAMPLING", "false").lower() == "true"
+TELEMETRY_SAMPLE_RATIO = float(os.getenv("TELEMETRY_SAMPLE_RATIO", "0.1"))
+TELEMETRY_SLOW_TRACE_SECONDS = float(os.getenv("TELEMETRY_SLOW_TRACE_SECONDS", "5"))
+TELEMETRY_MAX_BUFFERED_TRACES = int(os.getenv("TELEMETRY_MAX_BUFFERED_TRACES", "1000"))
+
+
+meter = metrics.get_meter(__name__)
+
+llm_duration = meter.create_histogram(
+    "llm.request.duration", unit="s", description="Duration of LLM chat completion calls")
+llm_time_to_first_token = meter.create_histogram(
+    "llm.time_to_first_token", unit="s", description="Time until the first token of a streamed completion")
+llm_prompt_tokens = meter.create_counter(
+    "llm.tokens.prompt", unit="{token}", description="Prompt tokens sent to the LLM")
+llm_completion_tokens = meter.create_counter(
+    "llm.tokens.completion", unit="{token}", description="Completion tokens generated by the LLM")
+llm_cached_tokens = meter.create_counter(
+    "llm.tokens.cached", unit="{token}", description="Prompt tokens served from the provider's prompt cache")
+llm_cache_hit_ratio = meter.create_histogram(
+    "llm.prompt_cache.hit_ratio", unit="1", description="Share of the prompt tokens served from the provider's prompt cache")
+llm_errors = meter.create_counter(
+    "llm.errors", unit="{error}", description="Failed LLM calls")
+llm_route_decisions = meter.create_counter(
+    "llm.route.decisions", unit="{turn}", description="Turns routed to the fast or strong deployment")
+llm_route_escalations = meter.create_counter(
+    "llm.route.escalations", unit="{turn}", description="Turns escalated from the fast to the strong deployment")
+llm_queue_delay = meter.create_histogram(
+    "llm.queue.delay", unit="s", description="Time LLM calls waited for the client-side rate limiter")
+llm_rate_limited = meter.create_counter(
+    "llm.rate_limited", unit="{response}", description="Rate limited (429) responses from the LLM service")
+
+tool_duration = meter.create_histogram(
+    "tool.duration", unit="s", description="Duration of function calls made on behalf of the LLM")
+tool_errors = meter.create_counter(
+    "tool.errors", unit="{error}", description="Failed function calls")
+
+search_took = meter.create_histogram(
+    "elasticsearch.search.took", unit="s", description="Search time reported by Elasticsearch")
+search_round_trip = meter.create_histogram(
+    "elasticsearch.search.round_trip", unit="s", description="Search time measured by the client")
+search_overhead = meter.create_histogram(
+    "elasticsearch.search.overhead", unit="s", description="Client round trip minus the time reported by Elasticsearch")
+rerank_duration = meter.create_histogram(
+    "search.rerank.duration", unit="s", description="CPU time of the local rerank stage")
+
+
+def record_llm_call(model, duration, usage, time_to_first_token=None, route=None):
+    """
+    Record the latency and token usage of one LLM call.
+
+    Args:
+        model (str): The model or deployment that was called.
+        duration (float): The duration of the call in seconds.
+        usage: The `usage` from the response, may be None.
+        time_to_first_token (float): Seconds until the first token, None if the call was not streamed.
+        route (str): The route chosen by the model router, if any.
+    """
+    attributes = {"llm.model": model}
+    if route:
+        attributes["llm.route"] = route
+    llm_duration.record(duration, attributes)
+    if time_to_first_token is not None:
+        llm_time_to_first_token.record(time_to_first_token, attributes)
+
+    span = trace.get_current_span()
+    if usage is None:
+        return
+    cached_tokens = 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    if details is not None and getattr(details, "cached_tokens", None):
+        cached_tokens = details.cached_tokens
+    llm_prompt_tokens.add(usage.prompt_tokens or 0, attributes)
+    llm_completion_tokens.add(usage.completion_tokens or 0, attributes)
+    llm_cached_tokens.add(cached_tokens, attributes)
+    span.set_attribute("llm.usage.prompt_tokens", usage.prompt_tokens or 0)
+    span.set_attribute("llm.usage.completion_tokens", usage.completion_tokens or 0)
+    span.set_attribute("llm.usage.cached_tokens", cached_tokens)
+    if usage.prompt_tokens:
+        hit_ratio = cached_tokens / usage.prompt_tokens
+        llm_cache_hit_ratio.record(hit_ratio, attributes)
+        span.set_attribute("llm.usage.cache_hit_ratio", hit_ratio)
+
+
+def record_llm_error(model, error):
+    """
+    Record a failed LLM call.
+    """
+    llm_errors.add(1, {"llm.model": model, "error.type": type(error).__name__})
+
+
+def record_queue_delay(delay, retries, concurrency):
+    """
+    Record how long an LLM call waited for the rate limiter.
+
+    Args:
+        delay (float): Seconds spent waiting, over every attempt.
+        retries (int): How many times the call was retried after a 429.
+        concurrency (float): The concurrency limit after the call.
+    """
+    llm_queue_delay.record(delay)
+    span = trace.get_current_span()
+    span.set_attribute("llm.queue_delay", delay)
+    span.set_attribute("llm.retries", retries)
+    span.set_attribute("llm.concurrency_limit", concurrency)
+
+
+def record_rate_limited(attempt):
+    """
+    Record a 429 response from the LLM service.
+    """
+    llm_rate_limited.add(1)
+    trace.get_current_span().add_event("Rate limited", {"attempt": attempt})
+
+
+def record_route(route, reason):
+    """
+    Record a routing decision on the current span and as a metric.
+
+    Args:
+        route (str): The chosen route, `fast` or `strong`.
+        reason (str): The signals that led to the decision.
+    """
+    llm_route_decisions.add(1, {"llm.route": route, "llm.route.reason": reason})
+    span = trace.get_current_span()
+    span.set_attribute("llm.route", route)
+    span.set_attribute("llm.route.reason", reason)
+
+
+def record_route_escalation(reason):
+    """
+    Record a turn escalated from the fast to the strong route.
+    """
+    llm_route_escalations.add(1, {"llm.route.reason": reason})
+    trace.get_current_span().set_attribute("llm.route.escalated", True)
+
+
+def record_tool_error(name, error_type):
+    """
+    Record a failed function call, including failures the function handled itself.
+
+    Args:
+        name (str): The name of the function.
+        error_type (str): The type of error, e.g. the exception class name.
+    """
+    tool_errors.add(1, {"tool.name": name, "error.type": error_type})
+    # Mark the span so the tail sampler keeps the trace
+    span = trace.get_current_span()
+    span.set_attribute("tool.error", error_type)
+    span.set_status(Status(StatusCode.ERROR, error_type))
+
+
+@contextmanager
+def measure_tool(name):
+    """
+    Context manager that records the duration of a function call, and an error if it raises.
+
+    Args:
+        name (str): The name of the function being called.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_tool_error(name, type(e).__name__)
+        raise
+    finally:
+        tool_duration.record(time.perf_counter() - start, {"tool.name": name})
+
+
+def record_search(took_ms, round_trip):
+    """
+    Record the server side and client side duration of an Elasticsearch search.
+
+    Args:
+        took_ms (int): The `took` value from the search response in milliseconds, may be None.
+        round_trip (float): The time the client waited for the response in seconds.
+    """
+    search_round_trip.record(round_trip)
+    span = trace.get_current_span()
+    span.set_attribute("elasticsearch.round_trip_ms", round(round_trip * 1000, 1))
+    if took_ms is None:
+        return
+    took = took_ms / 1000
+    search_took.record(took)
+    search_overhead.record(max(0.0, round_trip - took))
+    span.set_attribute("elasticsearch.took_ms", took_ms)
+
+
+def record_rerank(candidates, cpu_time, budget_exceeded=False):
+    """
+    Record the cost of reranking search candidates.
+
+    Args:
+        candidates (int): The number of candidates reranked.
+        cpu_time (float): The CPU time spent in seconds.
+        budget_exceeded (bool): True if the rerank ran out of its time budget.
+    """
+    rerank_duration.record(cpu_time, {"rerank.budget_exceeded": budget_exceeded})
+    span = trace.get_current_span()
+    span.set_attribute("rerank.candidates", candidates)
+    span.set_attribute("rerank.cpu_time", cpu_time)
+    span.set_attribute("rerank.budget_exceeded", budget_exceeded)
+
+
+def elasticsearch_headers(source, detail=None):
+    """
+    Build the headers that tie an Elasticsearch request to the current trace.
+
+    The X-Opaque-Id shows up in the Elasticsearch slow logs, the tasks API and deprecation
+    logs, the traceparent header carries the W3C trace context of the current span.
+
+    Args:
+        source (str): What is making the request, e.g. `search` or `index-pdfs`.
+        detail (str): Optional extra detail for the opaque id, e.g. the file being indexed. It is
+            percent-encoded, HTTP headers only take Latin-1.
+
+    Returns:
+        dict: The headers to pass to `es.options(headers=...)`.
+    """
+    headers = {}
+    propagate.inject(headers)
+    opaque_id = [source]
+    span_context = trace.get_current_span().get_span_context()
+    if span_context.is_valid:
+        opaque_id += [format(span_context.trace_id, "032x"), format(span_context.span_id, "016x")]
+    if detail:
+        opaque_id.append(quote(detail, safe=" /@.-_~()"))
+    headers["X-Opaque-Id"] = ":".join(opaque_id)
+    trace.get_current_span().set_attribute("elasticsearch.opaque_id", headers["X-Opaque-Id"])
+    return headers
+
+
+def record_search_profile(profile):
+    """
+    Attach the timing breakdown of a profiled search (`"profile": true`) to the current span.
+
+    Times are summed over the shards. The query phase is split by query type (e.g. the
+    nested query and the sparse_vector query inside it) and the fetch phase by sub-phase
+    (e.g. inner hits and _source loading).
+
+    Args:
+        profile (dict): The `profile` section of the search response.
+    """
+    phases = {}
+
+    def add(name, nanos):
+        phases[name] = phases.get(name, 0) + nanos
+
+    for shard in profile.get("shards", []):
+        for search in shard.get("searches", []):
+            add("rewrite", search.get("rewrite_time", 0))
+            for query in search.get("query", []):
+                add("query", query.get("time_in_nanos", 0))
+                add(f"query.{query.get('type')}", query.get("time_in_nanos", 0))
+                for child in query.get("children", []):
+                    add(f"query.{query.get('type')}.{child.get('type')}", child.get("time_in_nanos", 0))
+            for collector in search.get("collector", []):
+                add("collector", collector.get("time_in_nanos", 0))
+        fetch = shard.get("fetch")
+        if fetch:
+            add("fetch", fetch.get("time_in_nanos", 0))
+            for child in fetch.get("children", []):
+                add(f"fetch.{child.get('type')}", child.get("time_in_nanos", 0))
+
+    span = trace.get_current_span()
+    span.set_attribute("elasticsearch.profiled", True)
+    for name, nanos in phases.items():
+        span.set_attribute(f"elasticsearch.profile.{name}_ms", round(nanos / 1e6, 3))
+
+
+audit_dropped = meter.create_counter(
+    "audit.records.dropped", unit="{record}", description="Audit records dropped because the audit queue was full")
+
+
+def record_audit_dropped():
+    """
+    Record an audit record dropped by the audit sink's overflow policy.
+    """
+    audit_dropped.add(1)
+
+
+############################################
+# Payload limits
+############################################
+def limit_text(value, max_length=None):
+    """
+    Limit the size of text attached to spans and logs.
+
+    Text longer than the limit is truncated and tagged with its full length and a short
+    hash, so identical payloads can still be correlated. With TELEMETRY_HASH_TEXT=true
+    the text is replaced by the length and hash only.
+
+    Args:
+        value: The value to limit, anything that is not a string is returned unchanged.
+        max_length (int): The maximum length, defaults to TELEMETRY_MAX_TEXT_LENGTH.
+
+    Returns:
+        The limited value.
+    """
+    if not isinstance(value, str):
+        return value
+    if max_length is None:
+        max_length = TELEMETRY_MAX_TEXT_LENGTH
+    if len(value) <= max_length:
+        return value
+    digest = hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+    if TELEMETRY_HASH_TEXT:
+        return f"[{len(value)} chars sha256:{digest}]"
+    return f"{value[:max_length]}...[{len(value)} chars sha256:{digest}]"
+
+
+############################################
+# Reporting
+############################################
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile, shared by the benchmarks and reports so their figures compare.
+
+    Args:
+        values (list): The numbers.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+
+    Returns:
+        The smallest value with at least `fraction` of the values at or below it, None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Rounded first so float error (0.07 * 100 = 7.000000000000001) does not move up a rank
+    rank = math.ceil(round(fraction * len(ordered), 9))
+    return ordered[min(len(ordered) - 1, max(0, rank - 1))]
+
+
+############################################
+# Tail based sampling
+############################################
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    Span processor in front of the exporting processor that samples whole traces.
+
+    Head sampling: traces whose id falls in the sampled share are passed straight on, with the
+    same rule as the TraceIdRatioBased sampler, so they cost no buffering. Tail sampling: the
+    spans of every other trace are buffered until the local root span ends, and the trace is
+    only passed on if it was slow or had an error (including a handled tool failure).
+
+    A head sampler in the tracer provider is not used, it decides before a trace can turn out
+    slow or failed, and the traces it drops would never reach this processor.
+
+    Args:
+        delegates (list): The span processors (e.g. the BatchSpanProcessor) to pass kept spans to.
+        sample_ratio (float): The share of traces to keep whatever their outcome.
+        slow_seconds (float): Traces whose root span takes longer than this are always kept.
+        max_buffered_traces (int): The maximum number of unfinished traces to hold in memory.
+    """
+
+    def __init__(self, delegates, sample_ratio=TELEMETRY_SAMPLE_RATIO, slow_seconds=TELEMETRY_SLOW_TRACE_SECONDS,
+                 max_buffered_traces=TELEMETRY_MAX_BUFFERED_TRACES):
+        self.delegates = list(delegates)
+        self.sample_ratio = sample_ratio
+        self.slow_seconds = slow_seconds
+        self.max_buffered_traces = max_buffered_traces
+        self.lock = threading.Lock()
+        self.traces = OrderedDict()
+        self.kept = 0
+        self.dropped = 0
+
+    def on_start(self, span, parent_context=None):
+        for delegate in self.delegates:
+            delegate.on_start(span, parent_context=parent_context)
+
+    def head_sampled(self, trace_id):
+        """
+        Check whether a trace is in the sampled share, the same decision for the same trace id.
+        """
+        return (trace_id & 0xFFFFFFFFFFFFFFFF) < self.sample_ratio * (1 << 64)
+
+    def on_end(self, span):
+        trace_id = span.context.trace_id
+        is_root = span.parent is None or span.parent.is_remote
+        if self.head_sampled(trace_id):
+            if is_root:
+                self.kept += 1
+            for delegate in self.delegates:
+                delegate.on_end(span)
+            return
+        with self.lock:
+            spans = self.traces.setdefault(trace_id, [])
+            spans.append(span)
+            if is_root:
+                del self.traces[trace_id]
+            elif len(self.traces) > self.max_buffered_traces:
+                # The root of the oldest trace never finished, give up on it
+                self.traces.popitem(last=False)
+                self.dropped += 1
+        if not is_root:
+            return
+
+        if self.should_keep(span, spans):
+            self.kept += 1
+            for buffered_span in spans:
+                for delegate in self.delegates:
+                    delegate.on_end(buffered_span)
+        else:
+            self.dropped += 1
+
+    def should_keep(self, root, spans):
+        """
+        Decide whether to keep a finished trace.
+        """
+        if (root.end_time - root.start_time) / 1e9 >= self.slow_seconds:
+            return True
+        for span in spans:
+            if span.status.status_code == StatusCode.ERROR:
+                return True
+            if span.attributes and "tool.error" in span.attributes:
+                return True
+        return False
+
+    def shutdown(self):
+        for delegate in self.delegates:
+            delegate.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return all(delegate.force_flush(timeout_millis) for delegate in self.delegates)
+
+
+def _otlp_span_exporter():
+    """
+    Create the OTLP span exporter for the configured protocol, it reads the endpoint and headers from the environment.
+    """
+    protocol = os.getenv("OTEL_EXPORTER_OTLP_TRACES_PROTOCOL") or os.getenv("OTEL_EXPORTER_OTLP_PROTOCOL", "grpc")
+    if protocol.startswith("http"):
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    else:
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    return OTLPSpanExporter()
+
+
+def install_tail_sampling():
+    """
+    Export traces through a `TailSamplingSpanProcessor` when TELEMETRY_TAIL_SAMPLING=true.
+
+    The sampler wraps its own OTLP exporter and is added with `add_span_processor()`. The
+    exporter of `opentelemetry-instrument` has to be off (OTEL_TRACES_EXPORTER=none) or every
+    span would be exported by it as well.
+
+    Returns:
+        TailSamplingSpanProcessor: The installed processor, or None if it was not installed.
+    """
+    if not TELEMETRY_TAIL_SAMPLING:
+        return None
+    provider = trace.get_tracer_provider()
+    if not isinstance(provider, TracerProvider):
+        logger.warning("Tail sampling needs the OpenTelemetry SDK tracer provider, not enabling it")
+        return None
+    if os.getenv("OTEL_TRACES_EXPORTER", "otlp").lower() != "none":
+        logger.warning("Tail sampling needs OTEL_TRACES_EXPORTER=none, otherwise every span is exported anyway; not enabling it")
+        return None
+    sampler = TailSamplingSpanProcessor([BatchSpanProcessor(_otlp_span_exporter())])
+    provider.add_span_processor(sampler)
+    logger.info(f"Tail sampling enabled, keeping {TELEMETRY_SAMPLE_RATIO:.0%} of fast successful traces")
+    return sampler
@@ -0,0 +1,125 @@
+# tool_selection.py
+
+"""
+Pick the function definitions worth sending to the LLM for each turn.
+
+Every function definition is sent with every LLM call, including the follow-up calls after
+a function call, and the `search` definition alone carries the whole corpus description.
+Most turns only need one or two functions, so `ToolSelector` picks a subset per turn with
+cheap local matching:
+
+- Each module in `llm_functions` can declare `keywords`, a list of words or phrases that
+  make it relevant. A function is selected when one of its keywords is in the user's input.
+- Functions in the core set (TOOL_CORE_SET, comma separated) are always selected.
+- Questions about the assistant itself (e.g. "What can you do?") select every function.
+
+The definitions are part of the prompt prefix the provider caches (see prompt_prefix.py),
+so the selection of a session only ever grows: a function selected or called on an earlier
+turn stays selected. The core set comes first, in TOOL_CORE_SET order, followed by the other
+functions in the order they joined the session, so each turn's list starts with the previous
+turn's list. By default (TOOL_SELECTION_GROWTH=matched) only the matched functions are added.
+With TOOL_SELECTION_GROWTH=all the first function beyond the core set brings in every function,
+so a session's prefix changes at most once but later turns save nothing. The selection is
+worked out from the history, so no state is kept per session.
+
+Selected lists are cached, so the same list object (and serialisation) is reused for every
+turn that selects the same functions. TOOL_SELECTION=false sends every function on every
+turn as before.
+"""
+
+import os
+import re
+import json
+
+
+TOOL_SELECTION = os.getenv("TOOL_SELECTION", "true").lower() == "true"
+# How a session's selection grows beyond the core set: "all" functions at once, or only the "matched" ones
+TOOL_SELECTION_GROWTH = os.getenv("TOOL_SELECTION_GROWTH", "matched").lower()
+TOOL_CORE_SET = [name.strip() for name in os.getenv("TOOL_CORE_SET", "search").split(",") if name.strip()]
+
+# Questions about the assistant's capabilities need every function to answer
+ALL_TOOLS_KEYWORDS = ["what can you do", "what are you able", "your capabilities", "what functions", "which functions", "what tools", "which tools"]
+
+
+def _keyword_pattern(keywords):
+    """
+    Compile a case insensitive, whole word pattern matching any of the keywords.
+    """
+    if not keywords:
+        return None
+    alternatives = "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternatives})\b", re.IGNORECASE)
+
+
+class ToolSelector:
+    """
+    Select the function definitions relevant to a turn.
+
+    Args:
+        definitions (list): All function definitions, in the order they should be sent.
+        keywords (dict): The keywords of each function, by function name.
+        core_set (list): Names of the functions to always send.
+        enabled (bool): If False every definition is selected.
+    """
+
+    def __init__(self, definitions, keywords, core_set=TOOL_CORE_SET, enabled=TOOL_SELECTION):
+        self.definitions = definitions
+        self.enabled = enabled
+        self.core_set = [name for name in core_set if any(d["name"] == name for d in definitions)]
+        self.patterns = {name: _keyword_pattern(words) for name, words in keywords.items()}
+        self.all_tools_pattern = _keyword_pattern(ALL_TOOLS_KEYWORDS)
+        self.by_name = {definition["name"]: definition for definition in definitions}
+        self.cache = {}
+        self.all_tokens = self._tokens(definitions)
+
+    def _tokens(self, definitions):
+        """
+        Estimate the prompt tokens taken by a list of definitions (4 characters per token).
+        """
+        return len(json.dumps(definitions, separators=(",", ":"))) // 4
+
+    def matched(self, user_input):
+        """
+        Return the names of the functions whose keywords are in the user's input, in definition order.
+        """
+        if self.all_tools_pattern and self.all_tools_pattern.search(user_input):
+            return [definition["name"] for definition in self.definitions]
+        return [name for name, pattern in self.patterns.items() if pattern and pattern.search(user_input)]
+
+    def _session_names(self, user_input, history):
+        """
+        Return the names selected for the session so far plus this turn, in the order they joined.
+        """
+        names = dict.fromkeys(self.core_set)
+        for message in history:
+            if message.get("role") == "user":
+                names.update(dict.fromkeys(self.matched(message.get("content") or "")))
+            elif message.get("function_call"):
+                names[message["function_call"]["name"]] = None
+        names.update(dict.fromkeys(self.matched(user_input)))
+        if TOOL_SELECTION_GROWTH == "all" and any(name not in self.core_set for name in names):
+            # Beyond the core set go straight to every function, in a fixed order, so the prefix changes at most once
+            names = dict.fromkeys(self.core_set)
+            names.update(dict.fromkeys(self.by_name))
+        return tuple(name for name in names if name in self.by_name)
+
+    def select(self, user_input, history=()):
+        """
+        Select the definitions for a turn.
+
+        Args:
+            user_input (str): The user's input for this turn.
+            history (list): The conversation so far, the input may already be the last message.
+
+        Returns:
+            tuple: The selected definitions and the estimated prompt tokens saved per call.
+        """
+        if not self.enabled:
+            return self.definitions, 0
+
+        key = self._session_names(user_input, history)
+        cached = self.cache.get(key)
+        if cached is None:
+            selected = [self.by_name[name] for name in key]
+            cached = self.cache[key] = (selected, self.all_tokens - self._tokens(selected))
+        return cached
@@ -0,0 +1,75 @@
+# warmup.py
+
+"""
+Background warm-up of the clients the chat application depends on.
+
+The first turn used to pay for everything that is set up lazily: the TCP and TLS handshakes
+to the LLM endpoint and Elasticsearch, and the import of heavy libraries such as pandas and
+yfinance the first time a tool needs them. `start()` does that work in background threads
+while the user reads the greeting and types the first question:
+
+- the LLM client lists the models, a cheap request that checks the credentials and leaves
+  a pooled connection open for the first completion
+- every module in `llm_functions` can define a `warm_up()` function, e.g. `search` opens a
+  connection to Elasticsearch and the weather and stock tools import their libraries
+
+Failures are logged as warnings and never stop the application; the real call will report
+the problem again if it persists. Set WARMUP_ENABLED=false to skip the warm-up, or
+WARMUP_TOOLS=false to only warm up the LLM client.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from opentelemetry import trace
+
+
+logger = logging.getLogger()
+tracer = trace.get_tracer(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_TOOLS = os.getenv("WARMUP_TOOLS", "true").lower() == "true"
+
+
+def _run(name, task):
+    """
+    Run one warm-up task, logging how long it took or why it failed.
+    """
+    start = time.perf_counter()
+    with tracer.start_as_current_span(f"warm_up {name}") as span:
+        try:
+            task()
+        except Exception as e:
+            span.set_attribute("error.type", type(e).__name__)
+            logger.warning(f"Warm-up of {name} failed: {e}")
+            return
+    logger.debug(f"Warm-up of {name} took {time.perf_counter() - start:.2f}s")
+
+
+def start(client=None, tool_warm_ups=None):
+    """
+    Start warming up the LLM client and the tools in background threads.
+
+    Args:
+        client: The OpenAI or Azure OpenAI client, None to skip it.
+        tool_warm_ups (dict): The `warm_up()` functions of the tools, by function name.
+
+    Returns:
+        list: The started threads, so callers can wait for the warm-up if they need to.
+    """
+    if not WARMUP_ENABLED:
+        return []
+    tasks = {}
+    if client is not None:
+        # Listing the models checks the credentials without spending tokens
+        tasks["llm"] = lambda: client.models.list()
+    if WARMUP_TOOLS and tool_warm_ups:
+        tasks.update(tool_warm_ups)
+    threads = []
+    for name, task in tasks.items():
+        thread = threading.Thread(target=_run, args=(name, task), name=f"warm-up-{name}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads